@@ -1,4 +1,174 @@
-from collections.abc import Mapping, Iterable
+import re
+from array import array
+from bisect import bisect_right
+from collections.abc import Mapping, Iterable, Sequence
+from itertools import accumulate, chain
+
+# lazy sequences for chart algebra: rows (and the stitches in a row) are
+# worked out from the motifs on demand instead of being copied
+
+class _concat(Sequence):
+    def __init__(self, parts):
+        self.parts = parts
+        self.ends = list(accumulate(len(p) for p in parts))
+
+    def __len__(self):
+        return self.ends[-1] if self.ends else 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError
+        k = bisect_right(self.ends, i)
+        return self.parts[k][i - (self.ends[k-1] if k else 0)]
+
+    def __iter__(self):
+        return chain.from_iterable(self.parts)
+
+    def __reversed__(self):
+        return chain.from_iterable(reversed(p) for p in reversed(self.parts))
+
+class _repeat(Sequence):
+    def __init__(self, seq, n):
+        self.seq = seq
+        self.n = max(n, 0)
+
+    def __len__(self):
+        return len(self.seq) * self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError
+        return self.seq[i % len(self.seq)]
+
+    def __iter__(self):
+        for k in range(self.n):
+            yield from self.seq
+
+    def __reversed__(self):
+        for k in range(self.n):
+            yield from reversed(self.seq)
+
+class _side_by_side(Sequence):
+    # row i is left[i] followed by right[i]
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def __len__(self):
+        return len(self.left)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        return _concat((self.left[i], self.right[i]))
+
+class _widened(Sequence):
+    # row i is rows[i] repeated n times
+    def __init__(self, rows, n):
+        self.rows = rows
+        self.n = n
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        return _repeat(self.rows[i], self.n)
+
+def _parse_row(key, line, row, interned):
+    """The stitches of one chart line, right to left; row counts from the bottom, for errors."""
+    text = line.strip()
+    cells = interned.get(text)
+    if cells is None:
+        cells = []
+        for m in re.finditer(r"\S+", line):
+            try:
+                cells.append(key[m.group()])
+            except KeyError:
+                raise ValueError(f"chart row {row}, column {m.start() + 1}: unknown symbol {m.group()!r}") from None
+        cells.reverse()
+        interned[text] = cells
+    return cells
+
+def _lines_backwards(f, block=1 << 16):
+    # the lines of a binary file, last first, reading a block at a time
+    f.seek(0, 2)
+    end = f.tell()
+    tail = b""
+    while end > 0:
+        start = max(0, end - block)
+        f.seek(start)
+        lines = (f.read(end - start) + tail).split(b"\n")
+        tail = lines[0]
+        yield from reversed(lines[1:])
+        end = start
+    yield tail
+
+class _file_rows(Sequence):
+    """The rows of a chart file, bottom first, read from the file as they're used.
+
+    Identical lines share one parsed row, so memory goes with the number
+    of distinct rows. Iterating reads the file backwards from the end;
+    indexing scans it once for where each row starts.
+    """
+    def __init__(self, key, filename):
+        if not isinstance(key, Mapping):
+            raise TypeError
+        self.key = key
+        self.filename = filename
+        self._interned = {}
+        self._starts = None
+
+    def _row(self, line, row):
+        try:
+            return _parse_row(self.key, line.decode(), row, self._interned)
+        except ValueError as e:
+            raise ValueError(f"{self.filename}: {e}") from None
+
+    def __iter__(self):
+        with open(self.filename, "rb") as f:
+            row = 0
+            for line in _lines_backwards(f):
+                if line.strip():
+                    row += 1
+                    yield self._row(line, row)
+
+    def _index(self):
+        if self._starts is None:
+            starts = array('q')
+            with open(self.filename, "rb") as f:
+                pos = 0
+                for line in f:
+                    if line.strip():
+                        starts.append(pos)
+                    pos += len(line)
+            starts.reverse()
+            self._starts = starts
+        return self._starts
+
+    def __len__(self):
+        return len(self._index())
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [ self[j] for j in range(*i.indices(len(self))) ]
+        starts = self._index()
+        if i < 0:
+            i += len(starts)
+        if not 0 <= i < len(starts):
+            raise IndexError
+        with open(self.filename, "rb") as f:
+            f.seek(starts[i])
+            return self._row(f.readline(), i + 1)
 
 class chart(object):
 
@@ -26,28 +196,38 @@ class chart(object):
         else:
             rowstr = rowstr.replace("\r", "\n")
 
-        rows = [ [ key[i] for i in reversed(r.strip().split()) ] for r in reversed(rowstr.split("\n")) if len(r.strip()) > 0 ]
+        lines = [ r for r in reversed(rowstr.split("\n")) if len(r.strip()) > 0 ]
+        interned = {}
+        rows = [ _parse_row(key, r, i + 1, interned) for i, r in enumerate(lines) ]
 
         return rows
 
-    def _do(self, needle):
-        result = []
+    @classmethod
+    def load(cls, key, filename):
+        """A chart read from a text file laid out like a chart string, without reading it all in."""
+        return cls(_file_rows(key, filename))
+
+    def _expand(self, needle):
         for row in self.rows:
-            oriented_row = row if needle.orientation == 1 else reversed(row)
-            result.extend(needle.do(oriented_row))
+            yield row if needle.orientation == 1 else reversed(row)
             needle.end_row()
-        return result
+
+    def _do(self, needle):
+        return needle.do(self)
+
+    # composing charts makes views of their rows, so it costs the same
+    # however big the charts are
 
     def __add__(self, other):
         if len(self.rows) != len(other.rows):
             raise ValueError
-        return chart([ other.rows[i] + self.rows[i] for i in range(len(self.rows)) ])
+        return chart(_side_by_side(other.rows, self.rows))
 
     def __truediv__(self, other):
-        return chart(other.rows + self.rows)
+        return chart(_concat((other.rows, self.rows)))
 
     def __mul__(self, n):
-        return chart([ row * n for row in self.rows ])
+        return chart(_widened(self.rows, n))
 
     def __pow__(self, n):
-        return chart(self.rows * n)
+        return chart(_repeat(self.rows, n))
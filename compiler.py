@@ -0,0 +1,166 @@
+from collections import OrderedDict
+from collections.abc import Iterable
+import numpy as np
+
+from lang import (_base_verb, _with_color, _work_one_stitch, _work_stitches_together,
+                  _work_into_same_stitch, into_same_stitch, if_right_side, slip, slip_to_cable_needle)
+from lang import yarnover as _yarnover_verb, turn as _turn_verb
+from chart import chart
+
+# opcodes
+NODE = 0            # create_node(pulls[pull], count, kp, from_cable_needle=flag, color)
+YARNOVER = 1        # yarnover(color)
+SLIP = 2            # slip_stitch(front_or_back=flag)
+CABLE = 3           # slip_to_cable_needle(count, front_or_back=flag)
+INTO_CURRENT = 4    # work_into_current_node(kp, color)
+TURN = 5
+END_ROW = 6
+STITCHES = 7        # work_stitches(count, kp, color)
+
+instruction = np.dtype([ ('op', 'i1'), ('pull', 'i4'), ('count', 'i4'), ('kp', 'i1'), ('color', 'i2'), ('flag', 'i1') ])
+
+class program(object):
+    """A verb/chart program flattened into one instruction array.
+
+    Side-dependent branches are resolved for the orientation the program
+    was compiled for; pull specs and colors are interned in tables that
+    instructions index into (color -1 is the needle's own color).
+    """
+    def __init__(self, code, pulls, colors, orientation, end_row_turns):
+        self.code = code
+        self.pulls = pulls
+        self.colors = colors
+        self.orientation = orientation
+        self.end_row_turns = end_row_turns
+
+    def __len__(self):
+        return len(self.code)
+
+    def stitch_counts(self, start):
+        """Live stitches at the end of each row when run on start cast-on stitches, with no geometry built."""
+        from needles import symbolic
+
+        ndl = symbolic(self.end_row_turns)
+        ndl.cast_on(start)
+        ndl.orientation = self.orientation
+        ndl.run(self)
+        return ndl.row_counts
+
+    def save(self, filename):
+        np.savez(filename,
+                 code=self.code,
+                 pulls=np.array([ g for p in self.pulls for g in p ], dtype=int),
+                 pull_sizes=np.array([ len(p) for p in self.pulls ], dtype=int),
+                 colors=np.array(self.colors, dtype=str),
+                 orientation=np.array(self.orientation),
+                 end_row_turns=np.array(self.end_row_turns))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            groups = np.split(f["pulls"], np.cumsum(f["pull_sizes"])[:-1]) if len(f["pull_sizes"]) else []
+            return cls(f["code"], [ tuple(g.tolist()) for g in groups ], f["colors"].tolist(),
+                       int(f["orientation"]), bool(f["end_row_turns"]))
+
+class _compiler(object):
+    def __init__(self, orientation, end_row_turns):
+        self.start = orientation
+        self.orientation = orientation
+        self.end_row_turns = end_row_turns
+        self.code = []
+        self.pulls = {}
+        self.colors = {}
+        self.color = -1
+
+    def _pull(self, pull):
+        pull = (pull,) if isinstance(pull, int) else tuple(pull)
+        return self.pulls.setdefault(pull, len(self.pulls))
+
+    def _color(self, c):
+        return self.color if c is None else self.colors.setdefault(c, len(self.colors))
+
+    def emit(self, op, pull=0, count=0, kp=0, color=-1, flag=0):
+        self.code.append((op, pull, count, kp, color, flag))
+
+    def add(self, item):
+        if isinstance(item, str):
+            raise TypeError
+        elif isinstance(item, chart):
+            for row in item.rows:
+                self.add(row if self.orientation == 1 else list(reversed(row)))
+                self.emit(END_ROW)
+                if self.end_row_turns:
+                    self.orientation *= -1
+        elif isinstance(item, Iterable):
+            for i in item:
+                self.add(i)
+        elif isinstance(item, _base_verb):
+            self.add_verb(item)
+        else:
+            raise TypeError(f"can't compile {item!r}")
+
+    def add_verb(self, v):
+        if isinstance(v, _with_color):
+            old, self.color = self.color, self._color(v.color)
+            self.add(v.items)
+            self.color = old
+        elif isinstance(v, if_right_side):
+            self.add(v.right_side if self.orientation == 1 else v.wrong_side)
+        elif isinstance(v, into_same_stitch):
+            for item in [v.first] + v.rest:
+                self.add(item)
+        elif v is _turn_verb:
+            self.emit(TURN)
+            self.orientation *= -1
+        elif v is _yarnover_verb:
+            self.emit(YARNOVER, color=self.color)
+        elif isinstance(v, _work_into_same_stitch):
+            adv = v._adverb_dict
+            self.emit(INTO_CURRENT, kp=adv.get('knit_or_purl', 0), color=self._color(adv.get('color')))
+        elif isinstance(v, (_work_one_stitch, _work_stitches_together)):
+            adv = v._adverb_dict
+            pull = 1 if isinstance(v, _work_one_stitch) else v._parameter
+            times = 1 if isinstance(v, _work_stitches_together) or v._parameter is None else v._parameter
+            if times > 1 and not adv.get('from_cable_needle'):
+                self.emit(STITCHES, count=times, kp=adv.get('knit_or_purl', 0), color=self._color(adv.get('color')))
+                return
+            for i in range(times):
+                self.emit(NODE, self._pull(pull), 1, adv.get('knit_or_purl', 0), self._color(adv.get('color')),
+                          1 if adv.get('from_cable_needle') else 0)
+        elif isinstance(v, slip):
+            for i in range(1 if v._parameter is None else v._parameter):
+                self.emit(SLIP, flag=v._adverb_dict.get('front_or_back', 0))
+        elif isinstance(v, slip_to_cable_needle):
+            self.emit(CABLE, count=v._parameter, flag=v._adverb_dict.get('front_or_back', 0))
+        else:
+            raise TypeError(f"can't compile {v!r}")
+
+    def program(self):
+        return program(np.array(self.code, dtype=instruction).reshape(-1),
+                       [ p for p in self.pulls ], [ c for c in self.colors ],
+                       self.start, self.end_row_turns)
+
+# the most recently compiled programs, by identity of their items
+_cache = OrderedDict()
+_cache_size = 32
+
+def compile_program(items, ndl):
+    """Compile items for needle ndl as it stands now (its orientation and row ends).
+
+    The last few results are cached by the identity of items, so don't
+    change a program's lists after compiling it.
+    """
+    key = (id(items), ndl.orientation, ndl._end_row_turns)
+    cached = _cache.get(key)
+    if cached is not None and cached[0] is items:
+        _cache.move_to_end(key)
+        return cached[1]
+
+    c = _compiler(ndl.orientation, ndl._end_row_turns)
+    c.add(items)
+    prog = c.program()
+
+    _cache[key] = (items, prog)
+    while len(_cache) > _cache_size:
+        _cache.popitem(last=False)
+    return prog
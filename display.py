@@ -1,18 +1,21 @@
 import math
-from numpy import array, array_equal, cross
+from numpy import array, array_equal, argsort, cross, maximum, minimum, newaxis, ones, zeros
 from numpy.linalg import norm, det
 import tkinter
 
 from vectors import *
 
 class display(object):
-    def __init__(self, mesh):
+    def __init__(self, mesh, lod=True):
         self.mesh = mesh
         self.m = I
-        self.center = array([300,300])
+        self.size = array([600,600])
+        self.center = self.size // 2
         self.zoom = 100.0
         self.drag_xy = None
-        c = tkinter.Canvas(width=600, height=600)
+        # cull and simplify while dragging
+        self.lod = lod
+        c = tkinter.Canvas(width=self.size[0], height=self.size[1])
         c.pack()
 
         c.bind("<Button-1>", self.click)
@@ -26,60 +29,173 @@ class display(object):
         c.bind("<ButtonRelease-3>", self.release)
 
         self.canvas = c
+        self.worker = None
+
+        # segments per node, kept while the mesh geometry they came from is current
+        self._segment_cache = {}
+        self._segment_geometry = None
+        # canvas items redrawn while dragging, with the 3d points they follow
+        self._items = []
+        self._item_points = None
+        self._item_shown = None
+        self._outlines_hidden = False
 
         self.mesh.cook_vectors(True)
 
         self.draw_all(True)
 
+    def refresh(self, cook=True):
+        """Forget cached segment geometry after the mesh has moved, and redraw."""
+        if cook:
+            self.mesh.cook_vectors()
+        self._segment_cache = {}
+        self.draw_all(True)
+
+    def follow(self, worker, interval=100):
+        """Redraw from a solver.relax_worker as it runs; space pauses, escape stops."""
+        self.worker = worker
+        self.canvas.focus_set()
+        self.canvas.bind("<space>", self.toggle_pause)
+        self.canvas.bind("<Escape>", self.stop)
+        self.canvas.after(interval, self._poll, interval)
+        return self
+
+    def _poll(self, interval):
+        if self.worker.done:
+            self.worker.finish()
+            self.refresh()
+            return
+
+        # don't redraw under the user's drag; the snapshot waits for release
+        if self.drag_xy is None:
+            P = self.worker.take()
+            if P is not None:
+                self.worker.apply(P)
+                self.refresh(cook=False)
+
+        self.canvas.after(interval, self._poll, interval)
+
+    def toggle_pause(self, e=None):
+        if self.worker.paused:
+            self.worker.resume()
+        else:
+            self.worker.pause()
+
+    def stop(self, e=None):
+        self.worker.stop()
+
     def run(self):
         self.canvas.mainloop()
 
     def draw_all(self, full):
+        if not full and self._item_points is not None:
+            self._move_items()
+            return
+
         self.canvas.delete("all")
-        objs = [ n for n in self.mesh.objects if n.pos is not None ]
-        if full:
-            objs.sort(key=lambda n: self.m.dot(n.pos)[2])
-        for obj in objs:
-            for s in obj.get_draw_segments(self.m):
-                self.draw_segment(s, full)
-
-    def draw_segment(self, s, full):
-        points = s.points
+        self._outlines_hidden = False
+
+        # the mesh rebuilds its geometry when it moves; start over with it
+        geom = self.mesh.geometry()
+        if geom is not self._segment_geometry:
+            self._segment_cache = {}
+            self._segment_geometry = geom
+
+        # depth order and facing of every node from one projection
+        nodes = list(geom.index)
+        facing = geom.K.dot(self.m[2]) > 0
+        lines = []
+        for i in argsort(geom.P.dot(self.m[2]), kind='stable'):
+            for s in self._segments(nodes[i], facing[i]):
+                lines.extend(self._segment_lines(s))
+
+        points = array([ p for pts, color, thickness, outline, kw in lines for p in pts ], dtype=float).reshape(-1, 3)
+        xy = self.draw_pos(points)
+
+        self._items = []
+        fill_points = []
+        start = 0
+        for pts, color, thickness, outline, kw in lines:
+            coords = xy[start:start+len(pts)].ravel().tolist()
+            if outline:
+                self.canvas.create_line(coords, fill="black", width=self.zoom * thickness + 1, tags="outline", **kw)
+            else:
+                tags = ("fill", f"thickness {thickness}")
+                item = self.canvas.create_line(coords, fill=color, width=self.zoom * thickness - 1, tags=tags, **kw)
+                self._items.append((item, len(fill_points), len(pts), thickness))
+                fill_points.extend(range(start, start + len(pts)))
+            start += len(pts)
+        self._item_points = points[fill_points]
+        self._item_starts = array([ start for item, start, count, thickness in self._items ], dtype=int)
+        self._item_widths = array([ thickness for item, start, count, thickness in self._items ], dtype=float)
+        self._item_shown = ones(len(self._items), dtype=bool)
+
+    def _segments(self, obj, facing):
+        # the segment order of a node only depends on which way it faces
+        cached = self._segment_cache.get(obj)
+        if cached is None or cached[0] != facing:
+            cached = (facing, obj.get_draw_segments(self.m))
+            self._segment_cache[obj] = cached
+        return cached[1]
+
+    def _segment_lines(self, s):
+        """The canvas lines for a segment: (points, color, thickness, outline, options)."""
+        points = list(s.points)
         dots = []
         for i in (1, -1):
             if array_equal(points[i], points[i-1]):
-                dots.append(self.draw_pos(points.pop(i)))
-        points = [ self.draw_pos(p) for p in points ]
-        
-        if full:
-            for d in dots:
-                self.canvas.create_line([d, d],
-                                        fill = "black",
-                                        width = (self.zoom * s.thickness + 1),
-                                        capstyle=tkinter.ROUND
-                                        )
-            if len(points) > 1:
-                self.canvas.create_line(points,
-                                        fill = "black",
-                                        width = (self.zoom * s.thickness + 1),
-                                        smooth = True
-                                        )
+                dots.append(points.pop(i))
+
+        dot = { 'capstyle': tkinter.ROUND }
+        smooth = { 'smooth': True }
+
+        lines = [ ([d, d], s.color, s.thickness, True, dot) for d in dots ]
         if len(points) > 1:
-            self.canvas.create_line(points,
-                                    fill = s.color,
-                                    width = (self.zoom * s.thickness - 1),
-                                    smooth = True
-                                    )
-        for d in dots:
-            self.canvas.create_line([d, d],
-                                    fill = s.color,
-                                    width = (self.zoom * s.thickness - 1),
-                                    capstyle=tkinter.ROUND
-                                    )
-
-    def draw_pos(self, pos):
-        xyz = self.m.dot(pos)
-        return tuple(-xyz[0:2]*self.zoom + self.center)
+            lines.append((points, s.color, s.thickness, True, smooth))
+            lines.append((points, s.color, s.thickness, False, smooth))
+        lines.extend(([d, d], s.color, s.thickness, False, dot) for d in dots)
+        return lines
+
+    def _move_items(self, rezoom=False):
+        if not self._outlines_hidden:
+            self.canvas.itemconfigure("outline", state=tkinter.HIDDEN)
+            self._outlines_hidden = True
+
+        xy = self.draw_pos(self._item_points)
+
+        visible = ones(len(self._items), dtype=bool)
+        small = zeros(len(self._items), dtype=bool)
+        if self.lod and len(self._items):
+            # skip lines that are off the canvas, and draw sub-pixel ones straight
+            lo = minimum.reduceat(xy, self._item_starts)
+            hi = maximum.reduceat(xy, self._item_starts)
+            pad = (self.zoom * self._item_widths)[:, newaxis] / 2
+            visible = ((hi + pad >= 0) & (lo - pad <= self.size)).all(axis=1)
+            small = (hi - lo).max(axis=1) < 1
+
+        for k, (item, start, count, thickness) in enumerate(self._items):
+            if not visible[k]:
+                if self._item_shown[k]:
+                    self.canvas.itemconfigure(item, state=tkinter.HIDDEN)
+                    self._item_shown[k] = False
+                continue
+            if not self._item_shown[k]:
+                self.canvas.itemconfigure(item, state=tkinter.NORMAL)
+                self._item_shown[k] = True
+
+            pts = xy[start:start+count]
+            if small[k] and count > 2:
+                pts = pts[[0, -1]]
+            self.canvas.coords(item, *pts.ravel())
+
+        if rezoom:
+            for thickness in set(self._item_widths.tolist()):
+                self.canvas.itemconfigure(f"thickness {thickness}", width=self.zoom * thickness - 1)
+
+    def draw_pos(self, points):
+        """Canvas coordinates of an (n, 3) array of points."""
+        xyz = points.dot(self.m.T)
+        return -xyz[:, 0:2]*self.zoom + self.center
 
     def click(self, e):
         self.drag_xy = array([e.x, e.y])
@@ -115,6 +231,9 @@ class display(object):
             newzoom = self.zoom * math.exp(delta[1]*(-0.003))
             if newzoom > 20 and newzoom < 500:
                 self.zoom = newzoom
+                if self._item_points is not None:
+                    self._move_items(rezoom=True)
+                    return
             self.draw_all(False)
 
     def update_m(self, xy):
@@ -0,0 +1,80 @@
+import numpy as np
+
+from model import h_edge, v_edge
+from solver import _normalize
+
+class draw_geometry(object):
+    """Node frames and edge control points of a mesh, for drawing.
+
+    Everything is computed for the whole mesh in one pass from the cooked
+    node vectors, so each key point is worked out once per position change
+    rather than once for every segment that touches it.
+    """
+    def __init__(self, msh):
+        nodes = [ n for n in msh.nodes() if n.pos is not None ]
+        self.index = { n: i for i, n in enumerate(nodes) }
+
+        self.P = np.array([ n.pos for n in nodes ], dtype=float).reshape(-1, 3)
+        self.H = np.array([ n._h_arrow for n in nodes ], dtype=float).reshape(-1, 3)
+        self.V = np.array([ n._v_arrow for n in nodes ], dtype=float).reshape(-1, 3)
+        ks = np.array([ n.ks_norm for n in nodes ], dtype=float)
+        self.K = _normalize(np.cross(self.H, self.V)) * ks[:, None]
+
+        # horizontal stretch towards the neighbour on either side, zero at the ends
+        prev = np.array([ self.index.get(n._before.before, i) if n._before else i for i, n in enumerate(nodes) ], dtype=int)
+        after = np.array([ self.index.get(n._after.after, i) if n._after else i for i, n in enumerate(nodes) ], dtype=int)
+        self.E_bef = self.P - self.P[prev]
+        self.E_aft = self.P[after] - self.P
+
+        edges = [ e for e in msh.edges() if e.before in self.index and e.after in self.index ]
+        v = [ e for e in edges if isinstance(e, v_edge) ]
+        h = [ e for e in edges if isinstance(e, h_edge) ]
+        self.v_index = { e: i for i, e in enumerate(v) }
+        self.h_index = { e: i for i, e in enumerate(h) }
+
+        b, a, th = self._edge_arrays(v)
+        bn, an = self._col(b, [ n.rs_norm for n in nodes ]), self._col(a, [ n.rs_norm for n in nodes ])
+        self.v_points = np.stack([
+            self.key_points(b, -0.25*bn, 0.5*th*bn, -0.5*th, 0.5*th),
+            self.key_points(a, -0.25*an, -0.5*th*an, 0.5*th, 0*th),
+            self.key_points(a, 0.25*an, 0.5*th*an, 0.5*th, 0*th),
+            self.key_points(b, 0.25*bn, -0.5*th*bn, -0.5*th, 0.5*th),
+            ], axis=1)
+
+        b, a, th = self._edge_arrays(h)
+        one = np.ones_like(th)
+        self.h_points = np.stack([
+            self.key_points(b, 0.25*one, -0.5*th, -0.5*th, -0.5*th),
+            self.key_points(a, -0.25*one, 0.5*th, -0.5*th, -0.5*th),
+            ], axis=1)
+
+    def _edge_arrays(self, edges):
+        b = np.array([ self.index[e.before] for e in edges ], dtype=int)
+        a = np.array([ self.index[e.after] for e in edges ], dtype=int)
+        th = np.array([ e.thickness for e in edges ], dtype=float)
+        return b, a, th
+
+    @staticmethod
+    def _col(idx, values):
+        return np.array(values, dtype=float)[idx] if len(idx) else np.zeros(0)
+
+    def key_points(self, i, x_edge, x, y, z):
+        """node.key_point for the nodes at i, with one set of offsets per node."""
+        e = np.where((x_edge < 0)[:, None], self.E_bef[i], np.where((x_edge > 0)[:, None], self.E_aft[i], 0))
+        return (self.P[i] +
+                e * x_edge[:, None] +
+                self.H[i] * x[:, None] +
+                self.V[i] * y[:, None] +
+                self.K[i] * z[:, None])
+
+    def key_point(self, n, x_edge, x, y, z):
+        i = self.index[n]
+        e = self.E_bef[i] if x_edge < 0 else self.E_aft[i] if x_edge > 0 else 0
+        return (self.P[i] +
+                e * x_edge +
+                self.H[i] * x +
+                self.V[i] * y +
+                self.K[i] * z)
+
+    def ks_normal(self, n):
+        return self.K[self.index[n]]
@@ -14,21 +14,27 @@ front = _adverb('front_or_back', 1)
 back = _adverb('front_or_back', -1)
 from_cable_needle = _adverb('from_cable_needle', True)
 
-class _with_color(_base_verb):
+class _compound_verb(_base_verb):
+    # made of other verbs: needles work the items _expand gives, in its place
+    def _expand(self, ndl):
+        raise NotImplementedError
+
+    def _do(self, ndl):
+        return ndl.do(self)
+
+class _with_color(_compound_verb):
     def __init__(self, c, items):
         self.color = c
         self.items = items
 
-    def _do(self, ndl):
+    def _expand(self, ndl):
         old_color = ndl.color
         ndl.color = self.color
 
-        result = ndl.do(*self.items)
+        yield self.items
 
         ndl.color = old_color
 
-        return result
-
 class color(_adverb):
     def __init__(self, raw_color):
         _adverb.__init__(self, 'color', raw_color)
@@ -100,6 +106,12 @@ _work_stitch_adverbs_allowed = [ 'knit_or_purl', 'from_cable_needle', 'color' ]
 class _work_one_stitch(_repeating_verb, _clonable_verb):
     _adverbs_allowed = _work_stitch_adverbs_allowed
 
+    def _do(self, ndl):
+        # runs of plain stitches go to the needle in one call
+        if self._parameter is not None and self._parameter > 1 and not self._adverb_dict.get('from_cable_needle'):
+            return ndl.work_stitches(self._parameter, self._adverb_dict.get('knit_or_purl', 0), self._adverb_dict.get('color'))
+        return _repeating_verb._do(self, ndl)
+
     def _do_once(self, ndl):
         return ndl.create_node(1, 1, **self._adverb_dict)
 
@@ -140,7 +152,7 @@ class slip_to_cable_needle(_verb_with_params):
     def _do(self, ndl):
         return ndl.slip_to_cable_needle(self._parameter, **self._adverb_dict)
 
-class into_same_stitch(_base_verb):
+class into_same_stitch(_compound_verb):
 
     def __init__(self, first, *rest):
         self._validate_first(first)
@@ -158,11 +170,8 @@ class into_same_stitch(_base_verb):
         ## FIX
         pass
 
-    def _do(self, ndl):
-        result = []
-        for item in [self.first] + self.rest:
-            result.extend(ndl.do(item))
-        return result
+    def _expand(self, ndl):
+        return [self.first] + self.rest
 
 class _work_into_same_stitch(_base_verb):
     _adverbs_allowed = [ 'knit_or_purl', 'color' ]
@@ -181,7 +190,7 @@ class _work_into_same_stitch(_base_verb):
 knit_front_and_back = into_same_stitch(knit(1), knit(1))
 purl_front_and_back = into_same_stitch(purl(1), purl(1))
 
-class if_right_side(_base_verb):
+class if_right_side(_compound_verb):
     ## REVIEW INTERFACE
     ## ? if_right_side([A1,A2],[B1,B2])
     ## ? if_right_side(A1,A2)(B1,B2)
@@ -190,8 +199,8 @@ class if_right_side(_base_verb):
         self.right_side = right_side
         self.wrong_side = wrong_side
 
-    def _do(self, ndl):
+    def _expand(self, ndl):
         if ndl.orientation == 1:
-            return ndl.do(self.right_side)
+            return [self.right_side]
         else:
-            return ndl.do(self.wrong_side)
+            return [self.wrong_side]
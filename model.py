@@ -1,61 +1,292 @@
-from numpy import cross
+from numpy import array, cross, cumsum, empty, empty_like, concatenate
 from numpy.linalg import norm
-from math import exp, log, sin, atan
+from math import exp, log, sin, atan, sqrt
+from time import perf_counter
+from collections import deque
+from enum import IntEnum
 
 from vectors import zero
 
 class mesh(object):
     def __init__(self):
-        self.objects = []
+        self._objects = {}
         self.current_node_id = 0
         self.node_index = {}
+        self._edges = {}
+        self._crossovers = {}
+        self._blocks = {}
+        self.adjacency = adjacency()
+        self.history = relax_history()
+        self._geometry = None
+
+    @property
+    def objects(self):
+        return self._objects.keys()
+
+    def nodes(self):
+        return self.node_index.values()
+
+    def edges(self):
+        return self._edges.keys()
+
+    def crossovers(self):
+        return self._crossovers.keys()
+
+    def blocks(self):
+        return self._blocks.keys()
 
     def add(self, obj):
-        self.objects.append(obj)
+        self._objects[obj] = None
 
         if isinstance(obj, node):
             self.node_index[obj.id] = obj
+        elif isinstance(obj, edge):
+            self._edges[obj] = None
+            self.adjacency.attach(obj, obj.before)
+        elif isinstance(obj, crossover):
+            self._crossovers[obj] = None
+        elif isinstance(obj, block_force):
+            self._blocks[obj] = None
 
     def remove(self, obj):
-        self.objects.remove(obj)
+        del self._objects[obj]
 
         if isinstance(obj, node):
             del self.node_index[obj.id]
+        elif isinstance(obj, edge):
+            del self._edges[obj]
+            self.adjacency.detach(obj)
+        elif isinstance(obj, crossover):
+            del self._crossovers[obj]
+        elif isinstance(obj, block_force):
+            del self._blocks[obj]
+
+    def set_history(self, keep=0, every=None, forces=False):
+        self.history = relax_history(keep, every, forces)
+        return self.history
+
+    def history_forces(self, kind=None, node=None, last=None):
+        nodes = [ self.node_index[node] ] if node is not None else self.node_index.values()
+        for n in nodes:
+            frames = list(n.history)[-last:] if last else n.history
+            for frame in frames:
+                for f in frame.forces or []:
+                    if kind is None or f.kind == kind:
+                        yield f
 
     def next_node_id(self):
         self.current_node_id += 1
         return self.current_node_id
 
-    def relax(self, N=1):
-        self.cook_vectors(True)
-
-        for i in range(N):
-            forces = []
-
-            for obj in self.objects:
-                obj.push_history_frame()
-                forces.extend(obj.get_forces())
-
-            for f in forces:
-                f.apply()
-
-            self.cook_vectors()
+    def relax(self, N=None, vectorized=False, tol=None, budget=None, symmetry=None):
+        """Relax until N iterations, tol or budget, whichever comes first.
+
+        With none of them given it takes one iteration.
+        """
+        if N is None and tol is None and budget is None:
+            N = 1
+        solver = self.solver(vectorized, symmetry, tol)
+        record = relax_record()
+
+        for r in self.relax_steps(solver, N, tol, budget, record):
+            pass
+
+        solver.finish()
+        return record
+
+    def solver(self, vectorized=False, symmetry=None, tol=None):
+        """The relax engine for this mesh.
+
+        symmetry=k relaxes a circle or tube pattern made of k identical
+        wedges as one wedge (see solver.wedge_solver) until it moves less
+        than tol, then the whole mesh; it needs the vectorized engine.
+        """
+        from solver import object_solver, array_solver, wedge_solver
+
+        if vectorized and self.history.forces:
+            raise ValueError("force history is only recorded by the per-force engine")
+        if symmetry is not None:
+            if not vectorized:
+                raise ValueError("symmetric relaxing needs the vectorized engine")
+            return wedge_solver(self, symmetry, tol)
+
+        return array_solver(self) if vectorized else object_solver(self)
+
+    def relax_steps(self, solver, N=None, tol=None, budget=None, record=None):
+        """Step solver until N iterations, tol or budget, yielding record after each one.
+
+        record.time (and so the budget) counts the time spent stepping, not
+        the time the caller holds on to a yielded record.
+        """
+        if N is None and tol is None and budget is None:
+            raise ValueError("relax needs an iteration count, a tolerance or a time budget")
+
+        record = record or relax_record()
+
+        self.history.begin(solver.nodes, N)
+        try:
+            while N is None or record.iterations < N:
+                start = perf_counter()
+                self.history.record(record.iterations, solver.nodes, solver.current())
+                record.add(solver.step())
+                record.time += perf_counter() - start
+                yield record
+                if tol is not None and record.residuals[-1] < tol:
+                    record.converged = True
+                    break
+                if budget is not None and record.time >= budget:
+                    break
+        finally:
+            # the positions the last iteration left, however the run ends
+            self.history.record(record.iterations, solver.nodes, solver.current(), final=True)
 
     def center_all(self, C=zero):
-        nodes = [ n for n in self.objects if n.pos is not None ]
+        nodes = [ n for n in self.nodes() if n.pos is not None ]
         center = sum([n.pos for n in nodes]) / len(nodes)
-        forces = [ force(n,-center+C) for n in nodes ]
+        forces = [ force(force_kind.center, n, -center+C) for n in nodes ]
         
         for f in forces:
             f.apply()
 
+        self._geometry = None
+
     def cook_vectors(self, topo=False):
-        for n in self.objects:
+        if topo:
+            self._check_placed()
+        for n in self.node_index.values():
             n.cook_vectors(topo)
+        self._geometry = None
+
+    def _check_placed(self):
+        if any(n.pos is None for n in self.node_index.values()):
+            raise ValueError("deferred needle: call place() before relaxing or drawing")
+
+    def geometry(self):
+        """Drawing geometry for the current node positions, built on first use."""
+        if self._geometry is None:
+            self._check_placed()
+            from geometry import draw_geometry
+            self._geometry = draw_geometry(self)
+        return self._geometry
 
     def block(self, nodes, f):
         return block_force(self, nodes, f)
 
+class adjacency(object):
+    """Edges around each node, keyed by node id.
+
+    Kept up to date as edges are added, joined to their after node and
+    removed, so topology never has to be recovered by scanning node.edges.
+    """
+    def __init__(self):
+        self.before = {}
+        self.after = {}
+        self.up = {}
+        self.down = {}
+
+    def attach(self, e, n):
+        if e.before is n:
+            if isinstance(e, h_edge):
+                self.after.setdefault(n.id, e)
+            elif isinstance(e, v_edge):
+                self.up.setdefault(n.id, []).append(e)
+        if e.after is n:
+            if isinstance(e, h_edge):
+                self.before.setdefault(n.id, e)
+            elif isinstance(e, v_edge):
+                self.down.setdefault(n.id, []).append(e)
+
+    def detach(self, e):
+        for n, single, multi in ((e.before, self.after, self.up), (e.after, self.before, self.down)):
+            if n is None:
+                continue
+            if single.get(n.id) is e:
+                del single[n.id]
+            if e in multi.get(n.id, ()):
+                multi[n.id].remove(e)
+
+    def csr(self, nodes, eindex):
+        """Index arrays over nodes, with edges numbered by eindex (-1 if absent).
+
+        Returns before and after edge per node, and (indptr, indices) pairs
+        for the up and down edges of every node.
+        """
+        before = array([ eindex.get(self.before.get(n.id), -1) for n in nodes ], dtype=int)
+        after = array([ eindex.get(self.after.get(n.id), -1) for n in nodes ], dtype=int)
+
+        def pack(lists):
+            rows = [ lists.get(n.id, ()) for n in nodes ]
+            indptr = cumsum([0] + [ len(r) for r in rows ])
+            indices = array([ eindex.get(e, -1) for r in rows for e in r ], dtype=int)
+            return indptr, indices
+
+        return before, after, pack(self.up), pack(self.down)
+
+class relax_record(object):
+    def __init__(self):
+        self.iterations = 0
+        self.residuals = []
+        self.rms = []
+        self.converged = False
+        self.time = 0.0
+
+    def add(self, moved):
+        self.iterations += 1
+        self.residuals.append(float(moved.max()) if len(moved) else 0.0)
+        self.rms.append(sqrt(float((moved**2).mean())) if len(moved) else 0.0)
+
+    def __repr__(self):
+        return (f"relax_record(iterations={self.iterations}, residual={self.residuals[-1] if self.residuals else None}, "
+                f"converged={self.converged}, time={self.time:.3f})")
+
+class relax_history(object):
+    """What mesh.relax remembers about past node positions.
+
+    keep: frames kept per node in node.history (0 for none, None for all)
+    every: also sample all node positions every Nth iteration into one array
+    forces: record the forces applied in each per-node frame
+    """
+    def __init__(self, keep=0, every=None, forces=False):
+        if forces and keep == 0:
+            raise ValueError("force history needs per-node frames")
+        self.keep = keep
+        self.every = every
+        self.forces = forces
+
+        self.nodes = []
+        self.iterations = []
+        self._samples = empty((0, 0, 3))
+
+    def node_frames(self):
+        return deque(maxlen=self.keep)
+
+    def begin(self, nodes, N=None):
+        for n in nodes:
+            if n.history.maxlen != self.keep:
+                n.history = deque(n.history, maxlen=self.keep)
+
+        self.nodes = [ n.id for n in nodes ]
+        self.iterations = []
+        size = max(-(-N // self.every), 1) if self.every and N else 16
+        self._samples = empty((size if self.every else 0, len(nodes), 3))
+
+    def record(self, i, nodes, P, final=False):
+        """Store the positions P at the start of iteration i (or, if final, where the run ended)."""
+        if self.keep != 0:
+            for n, p in zip(nodes, P):
+                n.history.append(_history_frame(p, self.forces))
+
+        if self.every and (i % self.every == 0 or final):
+            k = len(self.iterations)
+            if k == len(self._samples):
+                self._samples = concatenate([self._samples, empty_like(self._samples)])
+            self._samples[k] = P
+            self.iterations.append(i)
+
+    @property
+    def samples(self):
+        return self._samples[:len(self.iterations)]
+
 class meshobject(object):
     def __init__(self, msh):
         self.pos = None
@@ -71,22 +302,18 @@ class meshobject(object):
     def cook_vectors(self, topo=False):
         pass
 
-    def push_history_frame(self):
-        pass
-
 class node(meshobject):
     def __init__(self, msh, pos, rs_norm, ks_norm, before, below):
         self.id = msh.next_node_id()
         meshobject.__init__(self, msh)
 
-        self.history = []
+        self.history = msh.history.node_frames()
 
         self.pos = pos
         self.rs_norm = rs_norm
         self.ks_norm = ks_norm
-        self.edges = [before] if before else []
-        self.edges.extend(below)
-        for e in self.edges: e.after = self
+        self.edges = []
+        for e in ([before] if before else []) + list(below): e.join(self)
 
     def get_forces(self):
         return (self._tension_forces() + self._hshear_forces() + self._hfold_forces() +
@@ -106,7 +333,7 @@ class node(meshobject):
 
         for e in tension_edges:
             delta = e.after.pos - e.before.pos
-            forces.extend(force.dot(f"n_tension node {self.id}", e, delta, norm(delta) / tension_ratio, 0.25))
+            forces.extend(force.dot(force_kind.n_tension, self, e, delta, norm(delta) / tension_ratio, 0.25))
 
         return forces
 
@@ -116,9 +343,9 @@ class node(meshobject):
         if norm(self._h_arrow) > 0:
             # correct horizontal shear of vertical edges
             for e in self._down:
-                forces.extend(force.dot(f"h_shear node {self.id}", e, self._h_arrow, 0, 0.1/len(self._down)))
+                forces.extend(force.dot(force_kind.h_shear, self, e, self._h_arrow, 0, 0.1/len(self._down)))
             for e in self._up:
-                forces.extend(force.dot(f"h_shear node {self.id}", e, self._h_arrow, 0, 0.1/len(self._up)))
+                forces.extend(force.dot(force_kind.h_shear, self, e, self._h_arrow, 0, 0.1/len(self._up)))
 
         return forces
 
@@ -129,9 +356,9 @@ class node(meshobject):
             # correct foldover of horizontal edges
             if self._before and self._after:
                 if self._h_arrow.dot(self.pos - self._before.before.pos) < 0:
-                    forces.extend(force.dot(f"h_fold node {self.id}", self._before, self._h_arrow, 0, 0.1))
+                    forces.extend(force.dot(force_kind.h_fold, self, self._before, self._h_arrow, 0, 0.1))
                 if self._h_arrow.dot(self._after.after.pos - self.pos) < 0:
-                    forces.extend(force.dot(f"h_fold node {self.id}", self._after, self._h_arrow, 0, 0.1))
+                    forces.extend(force.dot(force_kind.h_fold, self, self._after, self._h_arrow, 0, 0.1))
 
         return forces
 
@@ -141,9 +368,9 @@ class node(meshobject):
         if norm(self._v_arrow) > 0:
             # correct vertical shear of horizontal edges
             if self._before:
-                forces.extend(force.dot(f"v_shear node {self.id}", self._before, self._v_arrow, 0, 0.1))
+                forces.extend(force.dot(force_kind.v_shear, self, self._before, self._v_arrow, 0, 0.1))
             if self._after:
-                forces.extend(force.dot(f"v_shear node {self.id}", self._after, self._v_arrow, 0, 0.1))
+                forces.extend(force.dot(force_kind.v_shear, self, self._after, self._v_arrow, 0, 0.1))
 
         return forces
 
@@ -156,12 +383,12 @@ class node(meshobject):
         # align all edges with the plane of the node, with an offset for knit/purl curl moment
         if self._up and self._down:
             for e in self._up:
-                forces.extend(force.dot(f"n_flatten node {self.id}", e, normal, nsign*e.thickness, 0.1))
+                forces.extend(force.dot(force_kind.n_flatten, self, e, normal, nsign*e.thickness, 0.1))
             for e in self._down:
-                forces.extend(force.dot(f"n_flatten node {self.id}", e, normal, -nsign*e.thickness, 0.1))
+                forces.extend(force.dot(force_kind.n_flatten, self, e, normal, -nsign*e.thickness, 0.1))
         if self._before and self._after:
-            forces.extend(force.dot(f"n_flatten node {self.id}", self._before, normal, nsign*self._before.thickness, 0.1))
-            forces.extend(force.dot(f"n_flatten node {self.id}", self._after, normal, -nsign*self._after.thickness, 0.1))
+            forces.extend(force.dot(force_kind.n_flatten, self, self._before, normal, nsign*self._before.thickness, 0.1))
+            forces.extend(force.dot(force_kind.n_flatten, self, self._after, normal, -nsign*self._after.thickness, 0.1))
 
         return forces
 
@@ -183,36 +410,26 @@ class node(meshobject):
         if self._before is not None: edges_to_draw.append(self._before)
         if self._after is not None: edges_to_draw.append(self._after)
 
-        ks = m.dot(self.ks_normal())[2]
+        ks = m.dot(self.mesh.geometry().ks_normal(self))[2]
         if ks > 0: edges_to_draw.reverse()
 
         return sum([ e.draw_half_segments(self) for e in edges_to_draw ], [])
 
     def key_point(self, x_edge, x, y, z):
-        bef = self._before.before.pos if self._before and x_edge < 0 else self.pos
-        aft = self._after.after.pos if self._after and x_edge > 0 else self.pos
-        e = aft - bef
-
-        return (self.pos +
-                e * x_edge +
-                self._h_arrow * x +
-                self._v_arrow * y +
-                self.ks_normal() * z)
+        return self.mesh.geometry().key_point(self, x_edge, x, y, z)
 
     def cook_vectors(self, topo=False):
         if topo:
-            self._before = self.__before()
-            self._after = self.__after()
+            adj = self.mesh.adjacency
+            self._before = adj.before.get(self.id)
+            self._after = adj.after.get(self.id)
 
-            self._up = self.__up()
-            self._down = self.__down()
+            self._up = list(adj.up.get(self.id, ()))
+            self._down = list(adj.down.get(self.id, ()))
 
         self._h_arrow = self.__h_arrow()
         self._v_arrow = self.__v_arrow()
 
-    def push_history_frame(self):
-        self.history.append(_history_frame(self.pos))
-
     def __h_arrow(self):
         bef = self._before.before.pos if self._before else self.pos
         aft = self._after.after.pos if self._after else self.pos
@@ -240,22 +457,6 @@ class node(meshobject):
         else:
             return zero
 
-    def __before(self):
-        all_before = [e for e in self.edges if isinstance(e, h_edge) and e.after is self]
-        if all_before: return all_before[0]
-        else: return None
-
-    def __after(self):
-        all_after = [e for e in self.edges if isinstance(e, h_edge) and e.before is self]
-        if all_after: return all_after[0]
-        else: return None
-
-    def __down(self):
-        return [e for e in self.edges if isinstance(e, v_edge) and e.after is self]
-
-    def __up(self):
-        return [e for e in self.edges if isinstance(e, v_edge) and e.before is self]
-
 class bindoff_node(node):
     pass
 
@@ -316,21 +517,26 @@ class yarnover_node(node):
         return segments
 
 class _history_frame:
-    def __init__(self, pos):
+    def __init__(self, pos, forces=False):
         self.pos = pos
-        self.forces = []
+        self.forces = [] if forces else None
 
 class edge(meshobject):
     thick_mult = 0
 
     def __init__(self, msh, before, length, color, thickness):
-        meshobject.__init__(self, msh)
         self.before = before
         self.before.edges.append(self)
         self.after = None
         self.length = length
         self.color = color
         self.thickness = thickness
+        meshobject.__init__(self, msh)
+
+    def join(self, n):
+        self.after = n
+        n.edges.append(self)
+        self.mesh.adjacency.attach(self, n)
 
     def remove(self):
         if self.before: self.before.edges.remove(self)
@@ -338,7 +544,7 @@ class edge(meshobject):
         self.mesh.remove(self)
 
     def get_forces(self):
-        return force.dot(f"e_tension", self, self.after.pos - self.before.pos, self.length, 0.1)
+        return force.dot(force_kind.e_tension, None, self, self.after.pos - self.before.pos, self.length, 0.1)
 
     def draw_half_segments(self, n):
         return []
@@ -348,14 +554,8 @@ class v_edge(edge):
 
     def draw_half_segments(self, n):
         if self.before and self.after and n in (self.before, self.after):
-            th = self.thickness
-            bn = self.before.rs_norm
-            an = self.after.rs_norm
-
-            p1 = self.before.key_point(-0.25*bn, 0.5*th*bn, -0.5*th, 0.5*th)
-            p2 = self.after.key_point(-0.25*an, -0.5*th*an, 0.5*th, 0)
-            p3 = self.after.key_point(0.25*an, 0.5*th*an, 0.5*th, 0)
-            p4 = self.before.key_point(0.25*bn, -0.5*th*bn, -0.5*th, 0.5*th)
+            geom = self.mesh.geometry()
+            p1, p2, p3, p4 = geom.v_points[geom.v_index[self]]
 
             if n is self.before:
                 return [
@@ -374,9 +574,8 @@ class h_edge(edge):
 
     def draw_half_segments(self, n):
         if self.before and self.after and n in (self.before, self.after):
-            th = self.thickness
-            bef = self.before.key_point(0.25, -0.5*th, -0.5*th, -0.5*th)
-            aft = self.after.key_point(-0.25, 0.5*th, -0.5*th, -0.5*th)
+            geom = self.mesh.geometry()
+            bef, aft = geom.h_points[geom.h_index[self]]
 
             p1 = bef if n is self.before else aft
             p2 = (bef + aft) / 2
@@ -420,11 +619,10 @@ class crossover(meshobject):
 
             if over_dot - under_dot < self.thickness:
                 delta = self.thickness + under_dot - over_dot
-                desc = f"crossover ({self.over.before.id},{self.over.after.id}) / ({self.under.before.id},{self.under.after.id})"
                 for n in over_nodes:
-                    forces.append(force(desc, n, delta * normal * 0.1))
+                    forces.append(force(force_kind.crossover, n, delta * normal * 0.1, self))
                 for n in under_nodes:
-                    forces.append(force(desc, n, -delta * normal * 0.1))
+                    forces.append(force(force_kind.crossover, n, -delta * normal * 0.1, self))
 
         return forces
 
@@ -435,26 +633,53 @@ class block_force(meshobject):
         self.f = f
 
     def get_forces(self):
-        return [ force(n, self.f(n)) for n in self.nodes ]
+        return [ force(force_kind.block, n, self.f(n), self) for n in self.nodes ]
+
+class force_kind(IntEnum):
+    n_tension = 1
+    h_shear = 2
+    h_fold = 3
+    v_shear = 4
+    n_flatten = 5
+    e_tension = 6
+    crossover = 7
+    block = 8
+    center = 9
 
 class force(object):
-    def __init__(self, desc, N, D):
-        self.description = desc
+    def __init__(self, kind, N, D, source=None, edge=None):
+        self.kind = kind
         self.node = N
         self.delta = D
+        self.source = source
+        self.edge = edge
+
+    @property
+    def description(self):
+        desc = self.kind.name
+        if isinstance(self.source, node):
+            desc = f"{desc} node {self.source.id}"
+        elif isinstance(self.source, crossover):
+            o, u = self.source.over, self.source.under
+            desc = f"{desc} ({o.before.id},{o.after.id}) / ({u.before.id},{u.after.id})"
+        if self.edge is not None:
+            desc = f"{desc} edge({self.edge.before.id},{self.edge.after.id})"
+        return desc
+
+    def __repr__(self):
+        return f"force({self.description} -> node {self.node.id})"
 
     def apply(self):
         self.node.pos = self.node.pos + self.delta
-        if self.node.history:
+        if self.node.history and self.node.history[-1].forces is not None:
             self.node.history[-1].forces.append(self)
 
     @classmethod
-    def dot(cls, desc, e, arrow, offset, strength):
+    def dot(cls, kind, source, e, arrow, offset, strength):
         n = norm(arrow)
         if n > 0:
-            desc = f"{desc} edge({e.before.id},{e.after.id})"
             arrow = arrow / n
             delta = arrow * (arrow.dot(e.after.pos - e.before.pos) - offset) * strength
-            return [ cls(desc, e.before, delta), cls(desc, e.after, -delta) ]
+            return [ cls(kind, e.before, delta, source, e), cls(kind, e.after, -delta, source, e) ]
         else:
             return []
@@ -1,14 +1,102 @@
 import math
-from numpy import ndarray, cross
+from numpy import ndarray, array, add, arctan2, argsort, concatenate, cross, cumsum, flatnonzero, newaxis, repeat, zeros, zeros_like
 from numpy.linalg import norm
-from collections import deque
 from collections.abc import Iterable
 
 from model import *
 from vectors import *
 
+class _stitch_ring(object):
+    """Double-ended stitch queue with O(1) indexing and O(1) reversal.
+
+    Stitches live in a circular buffer; reverse() only flips which end
+    of the buffer counts as the left.
+    """
+    def __init__(self):
+        self._buf = [None] * 8
+        self._head = 0
+        self._size = 0
+        self._reversed = False
+
+    def __len__(self):
+        return self._size
+
+    def _slot(self, i):
+        if i < 0:
+            i += self._size
+        if not 0 <= i < self._size:
+            raise IndexError("stitch index out of range")
+        if self._reversed:
+            i = self._size - 1 - i
+        return (self._head + i) % len(self._buf)
+
+    def __getitem__(self, i):
+        return self._buf[self._slot(i)]
+
+    def __setitem__(self, i, s):
+        self._buf[self._slot(i)] = s
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self[i]
+
+    def _grow(self):
+        n = len(self._buf)
+        self._buf = [ self._buf[(self._head + i) % n] for i in range(self._size) ] + [None] * n
+        self._head = 0
+
+    def _push_front(self, s):
+        if self._size == len(self._buf):
+            self._grow()
+        self._head = (self._head - 1) % len(self._buf)
+        self._buf[self._head] = s
+        self._size += 1
+
+    def _push_back(self, s):
+        if self._size == len(self._buf):
+            self._grow()
+        self._buf[(self._head + self._size) % len(self._buf)] = s
+        self._size += 1
+
+    def _pop_front(self):
+        if not self._size:
+            raise IndexError("pop from an empty stitch ring")
+        s, self._buf[self._head] = self._buf[self._head], None
+        self._head = (self._head + 1) % len(self._buf)
+        self._size -= 1
+        return s
+
+    def _pop_back(self):
+        if not self._size:
+            raise IndexError("pop from an empty stitch ring")
+        self._size -= 1
+        i = (self._head + self._size) % len(self._buf)
+        s, self._buf[i] = self._buf[i], None
+        return s
+
+    def append(self, s):
+        self._push_front(s) if self._reversed else self._push_back(s)
+
+    def appendleft(self, s):
+        self._push_back(s) if self._reversed else self._push_front(s)
+
+    def pop(self):
+        return self._pop_front() if self._reversed else self._pop_back()
+
+    def popleft(self):
+        return self._pop_back() if self._reversed else self._pop_front()
+
+    def reverse(self):
+        self._reversed = not self._reversed
+
+# end of an item list on the do() stack
+_done = object()
+
 class __base(object):
-    def __init__(self, rpi=5, spi=5, wpi=15, color="gray"):
+    # whether end_row() turns the work, for compiling if_right_side
+    _end_row_turns = False
+
+    def __init__(self, rpi=5, spi=5, wpi=15, color="gray", deferred=False, batched=False):
         self.rpi = rpi
         self.spi = spi
         self.wpi = wpi
@@ -16,44 +104,210 @@ class __base(object):
 
         self.mesh = mesh()
 
-        self.stitches = deque()
+        self.stitches = _stitch_ring()
         self.loose_edge = None
         self.orientation = 1
 
-        self.cable_stitches = deque()
+        self.cable_stitches = _stitch_ring()
         self.cable_side = None
 
         self._current_node = None
         self._to_be_relaxed = 0
 
+        # build topology only, and position new nodes in place() before relaxing
+        self.deferred = deferred
+        self._pending = []
+
+        # work runs of plain stitches in batches, relaxing once per batch;
+        # faster, but increases and decreases start out a little differently
+        self.batched = batched
+
     def _row_height(self): return 1.0 / self.rpi
     def _stitch_width(self): return 1.0 / self.spi
     def _yarn_thickness(self): return 1.0 / self.wpi
 
-    def do(self, *args):
-        result = []
-        for item in args:
-            if isinstance(item, str):
+    def do(self, *args, each=None, collect=True):
+        """Work args, returning the nodes made (None if not collect); each(node) is called as they're made."""
+        result = [] if collect else None
+        for n in self.stream(*args):
+            if each is not None:
+                each(n)
+            if collect:
+                result.append(n)
+        return result
+
+    def stream(self, *args):
+        """Work args like do(), yielding each node as it is made.
+
+        Nested lists and compound verbs and charts (anything with an
+        _expand) are walked with an explicit stack, not recursion.
+        """
+        stack = [iter(args)]
+        while stack:
+            item = next(stack[-1], _done)
+            if item is _done:
+                stack.pop()
+            elif isinstance(item, str):
                 raise TypeError
+            elif hasattr(item, '_expand'):
+                stack.append(iter(item._expand(self)))
             elif isinstance(item, Iterable):
-                result.extend(self.do(*item))
+                stack.append(iter(item))
             else:
-                result.extend(item._do(self))
+                yield from item._do(self)
+
+    def run(self, prog):
+        """Execute a compiler.program, e.g. compile_program(items, self), like do(items)."""
+        import compiler as c
+
+        if prog.orientation != self.orientation or prog.end_row_turns != self._end_row_turns:
+            raise ValueError("program was compiled for a different needle state")
 
+        result = []
+        pulls, colors = prog.pulls, prog.colors
+        for op, pull, count, kp, color, flag in prog.code.tolist():
+            color = colors[color] if color >= 0 else None
+            if op == c.NODE:
+                result.extend(self.create_node(pulls[pull], count, kp, bool(flag), color))
+            elif op == c.YARNOVER:
+                result.extend(self.yarnover(color))
+            elif op == c.SLIP:
+                self.slip_stitch(flag)
+            elif op == c.CABLE:
+                self.slip_to_cable_needle(count, flag)
+            elif op == c.INTO_CURRENT:
+                self.work_into_current_node(kp, color)
+            elif op == c.TURN:
+                self.turn()
+            elif op == c.END_ROW:
+                self.end_row()
+            elif op == c.STITCHES:
+                result.extend(self.work_stitches(count, kp, color))
         return result
 
+    def _pending_sources(self, inbound):
+        # the nodes a new node's position is worked out from, and whether it is displaced
+        if inbound:
+            return [ s.before for s in inbound ], True
+        elif self.loose_edge:
+            return [ self.loose_edge.before ], False
+        elif self.stitches and self.stitches[-1]:
+            return [ self.stitches[-1].before ], True
+        else:
+            raise ValueError
+
+    def place(self):
+        """Position the nodes built since the last place() in deferred mode.
+
+        Nodes are placed one row-deep level at a time, each level worked
+        out from its sources in one batch. Construction relaxation is
+        stood in for by fitting each node to the stitches on the needle
+        when it was made, and spreading nodes that land on the same spot
+        a stitch apart along the row.
+        """
+        pending, self._pending = self._pending, []
+        if not pending:
+            return []
+
+        slot = { p[0]: i for i, p in enumerate(pending) }
+        fixed = {}
+        src, level, copy = [], [], []
+        for i, (n, sources, displace, live) in enumerate(pending):
+            src.append([ slot[m] if m in slot else len(pending) + fixed.setdefault(m, len(fixed)) for m in sources ])
+            known = [ level[slot[m]] for m in sources if m in slot ]
+            if displace:
+                level.append(1 + max(known, default=-1))
+                copy.append(-1)
+            else:
+                # a yarnover sits on the node before it, in the same level
+                j = src[i][0]
+                level.append(max(known, default=0))
+                copy.append(copy[j] if j < i and copy[j] >= 0 else j)
+
+        Q = zeros((len(pending) + len(fixed), 3))
+        for m, i in fixed.items():
+            Q[len(pending) + i] = m.pos
+        level, copy = array(level), array(copy)
+        live = array([ p[3] for p in pending ])
+        rs = array([ p[0].rs_norm for p in pending ], dtype=float)
+
+        # arrows for orientation 1, turned per node by its rs_norm
+        orientation, self.orientation = self.orientation, 1
+        for l in range(level.max() + 1):
+            idx = flatnonzero((level == l) & (copy < 0))
+            if len(idx):
+                counts = array([ len(src[i]) for i in idx ])
+                starts = concatenate([[0], cumsum(counts)[:-1]])
+                P = add.reduceat(Q[array([ j for i in idx for j in src[i] ], dtype=int)], starts, axis=0)
+                Q[idx] = self._fit_all(self._displace_all(P / counts[:, newaxis]), live[idx])
+            idx = flatnonzero((level == l) & (copy >= 0))
+            Q[idx] = Q[copy[idx]]
+
+            # nodes on one spot, in the order they were made
+            idx = flatnonzero(level == l)
+            spots = [ bytes(q) for q in Q[idx] ]
+            seen, rank = {}, []
+            for k in spots:
+                rank.append(seen.get(k, 0))
+                seen[k] = rank[-1] + 1
+            rank = array(rank, dtype=float)
+            size = array([ seen[k] for k in spots ], dtype=float)
+            spread = size > 1
+            if spread.any():
+                i = idx[spread]
+                shift = (rank[spread] - (size[spread] - 1) / 2) * self._stitch_width()
+                Q[i] += self._arrows(Q[i]) * (rs[i] * shift)[:, newaxis]
+
+            # and put each run along the yarn back in the order it was worked, as for cables
+            for run in self._yarn_runs([ pending[i][0] for i in idx ]):
+                i = array([ slot[n] for n in run ])
+                if len(i) > 1:
+                    Q[i] = Q[i[argsort(self._along(Q[i], rs[i[0]]), kind='stable')]]
+        self.orientation = orientation
+
+        for i, p in enumerate(pending):
+            p[0].pos = Q[i].copy()
+        self.mesh._geometry = None
+        return [ p[0] for p in pending ]
+
+    def _fit_all(self, P, live):
+        return P
+
+    def _yarn_runs(self, nodes):
+        # split nodes into runs that follow each other along the yarn on one side
+        before = self.mesh.adjacency.before
+        runs = []
+        for n in nodes:
+            e = before.get(n.id)
+            if runs and e is not None and e.before is runs[-1][-1] and n.rs_norm == runs[-1][-1].rs_norm:
+                runs[-1].append(n)
+            else:
+                runs.append([n])
+        return runs
+
+    def _along(self, P, orientation):
+        # distance along the row in the knitting direction
+        raise NotImplementedError
+
     def _displace(self, pos):
         raise NotImplementedError
 
+    def _displace_all(self, P):
+        return array([ self._displace(p) for p in P ], dtype=float).reshape(-1, 3)
+
     def cast_on(self, N):
         raise NotImplementedError
 
     def _arrow(self, pos):
         raise NotImplementedError
 
+    def _arrows(self, P):
+        return array([ self._arrow(p) for p in P ], dtype=float)
+
     def _relax(self):
         if not self.cable_stitches:
-            self._relax_nodes(self._find_nodes_to_relax())
+            if not self.deferred:
+                self._relax_nodes(self._find_nodes_to_relax())
             self._to_be_relaxed = 0
             self.cable_side = None
         
@@ -83,17 +337,33 @@ class __base(object):
         return working
 
     def _relax_nodes(self, working):
+        # each inner node is pulled toward one stitch width from its neighbours,
+        # all from the positions at the start of the iteration
+        moved = array([ i for i in range(1, len(working) - 1) if working[i] is not None ], dtype=int)
+        if not len(moved):
+            return
+
+        P = array([ n.pos if n is not None else zero for n in working ], dtype=float)
+
+        # neighbours on both sides at once, with no pull from a missing neighbour
+        nbr = array([ moved - 1, moved + 1 ])
+        offset = array([ -1, 1 ])[:, newaxis, newaxis] * self._stitch_width()
+        strength = array([ [ 0 if working[i] is None else 0.5 for i in side ] for side in nbr ])[:, :, newaxis]
+
         for k in range(len(working)*15):
-            forces = []
-            for i in range(1,len(working) - 1):
-                for j in (-1,1):
-                    if working[i+j] is not None:
-                        arrow = self._arrow(working[i].pos)
-                        target = working[i+j].pos + j*self._stitch_width()*arrow
-                        delta = arrow * arrow.dot(target - working[i].pos)
-                        delta *= 0.5
-                        forces.append(force(None, working[i], delta))
-            for f in forces: f.apply()
+            pos = P[moved]
+            arrow = self._arrows(pos)
+            delta = arrow * (arrow * (P[nbr] + offset*arrow - pos)).sum(axis=2)[:, :, newaxis]
+            delta *= strength
+            step = delta[0] + delta[1]
+            P[moved] = pos + step
+
+            # settled; in batches, plain rows usually are from the start
+            if self.batched and abs(step).max() < 1e-12:
+                break
+
+        for i in moved:
+            working[i].pos = P[i]
 
     def _pop_stitch(self, from_cable=False):
         q = self.cable_stitches if from_cable else self.stitches
@@ -124,7 +394,9 @@ class __base(object):
             if knit_or_purl < 0:
                 inbound.reverse()
 
-            if inbound:
+            if self.deferred:
+                pending = self._pending_sources(inbound)
+            elif inbound:
                 newpos = self._displace(sum([s.before.pos for s in inbound]) / len(inbound))
 
             else:
@@ -149,12 +421,49 @@ class __base(object):
 
         self._current_node = new_node
 
+        if newpos is None:
+            self._pending.append((new_node,) + pending + (len(self.stitches),))
+
         if isinstance(pull, tuple) and push > 0:
             self._to_be_relaxed += 1
             self._relax()
 
         return [new_node]
 
+    def work_stitches(self, count, knit_or_purl=0, color=None):
+        """Work count plain stitches, each into one stitch, in batches.
+
+        The same as count calls to create_node(1, 1, ...), except that on a
+        batched needle each batch of new positions is worked out in one go
+        and relaxed once, after the batch, rather than after every stitch.
+        """
+        if not self.batched:
+            return [ n for i in range(count) for n in self.create_node(1, 1, knit_or_purl, color=color) ]
+
+        color = color or self.color
+        result = []
+        while count > 0:
+            # a batch can't reach the stitches it makes itself, and
+            # leaves one to hold the relaxation
+            k = max(1, min(count, len(self.stitches) - 1))
+            inbound = [ self._pop_stitch() for i in range(k) ]
+            if not self.deferred:
+                P = self._displace_all(array([ s.before.pos for s in inbound ], dtype=float))
+
+            for i, s in enumerate(inbound):
+                new_node = node(self.mesh, None if self.deferred else P[i], self.orientation, knit_or_purl, self.loose_edge, [s])
+                if self.deferred:
+                    self._pending.append((new_node, [ s.before ], True, len(self.stitches) + k - i))
+                self._push_stitch(v_edge(self.mesh, new_node, self._row_height(), color, self._yarn_thickness()))
+                self.loose_edge = h_edge(self.mesh, new_node, self._stitch_width(), color, self._yarn_thickness())
+                result.append(new_node)
+
+            self._current_node = result[-1]
+            self._to_be_relaxed += k
+            self._relax()
+            count -= k
+        return result
+
     def work_into_current_node(self, knit_or_purl=0, color=None):
         if self._current_node is None:
             raise ValueError
@@ -168,8 +477,8 @@ class __base(object):
             self.cable_side = front_or_back
         return []
 
-    def yarnover(self):
-        result = self.create_node(0, 1, node_class=yarnover_node)
+    def yarnover(self, color=None):
+        result = self.create_node(0, 1, color=color, node_class=yarnover_node)
         self.stitches[0].length = self._yarn_thickness()
         return result
 
@@ -207,9 +516,14 @@ class __base(object):
         return self.create_node(1, 0, knit_or_purl=knit_or_purl, node_class=bindoff_node)
 
 class flat(__base):
+    _end_row_turns = True
+
     def _displace(self, pos):
         return pos + Y*self._row_height()
 
+    def _displace_all(self, P):
+        return P + Y*self._row_height()
+
     def cast_on(self, N):
         self.stitches.append(None)
         self.turn()
@@ -226,6 +540,12 @@ class flat(__base):
     def _arrow(self, pos):
         return X * self.orientation
 
+    def _arrows(self, P):
+        return repeat(self._arrow(None)[newaxis], len(P), axis=0)
+
+    def _along(self, P, orientation):
+        return P[:, 0] * orientation
+
     def end_row(self):
         self.turn()
 
@@ -236,6 +556,12 @@ class circle(__base):
             raise ValueError
         return pos * (ns + self._row_height()) / ns
 
+    def _displace_all(self, P):
+        ns = norm(P, axis=1)
+        if (ns == 0).any():
+            raise ValueError
+        return P * (ns + self._row_height())[:, newaxis] / ns[:, newaxis]
+
     def _arrow(self, pos):
         a = cross(pos, Z) * self.orientation
         na = norm(a)
@@ -243,6 +569,21 @@ class circle(__base):
             raise ValueError
         return a / na
 
+    def _arrows(self, P):
+        # cross(P, Z), row by row
+        a = zeros_like(P)
+        a[:, 0] = P[:, 1] * self.orientation
+        a[:, 1] = -P[:, 0] * self.orientation
+        na = norm(a, axis=1)
+        if (na == 0).any():
+            raise ValueError
+        return a / na[:, newaxis]
+
+    def _along(self, P, orientation):
+        # angle round from the first point
+        t = -arctan2(P[:, 1], P[:, 0]) * orientation
+        return (t - t[0]) % (2*math.pi)
+
     def cast_on(self, N, cinch=False):
         R = N * self._stitch_width() / (2*math.pi)
         positions = [(math.sin(t)*X + math.cos(t)*Y)*R for t in [i*math.pi*2/N for i in range(N)]]
@@ -251,8 +592,7 @@ class circle(__base):
             result.extend(self.create_node(p, 1))
             if cinch: self.loose_edge.length *= 0.25
 
-        self.loose_edge.after = self.stitches[-1].before
-        self.stitches[-1].before.edges.append(self.loose_edge)
+        self.loose_edge.join(self.stitches[-1].before)
         self.loose_edge = None
         return result
 
@@ -260,6 +600,9 @@ class tube(circle):
     def _displace(self, pos):
         return pos - Z * self._row_height()
 
+    def _displace_all(self, P):
+        return P - Z * self._row_height()
+
     def _relax_nodes(self, working):
         R = len(self.stitches) * self._stitch_width() / (2*math.pi)
         for n in working:
@@ -270,3 +613,140 @@ class tube(circle):
                 n.pos[0:2] *= R / r
 
         circle._relax_nodes(self, working)
+
+    def _fit_all(self, P, live):
+        # round out to the stitches on the needle, as _relax_nodes does
+        r = norm(P[:, 0:2], axis=1)
+        if (r == 0).any():
+            raise ValueError
+        P = P.copy()
+        P[:, 0:2] *= (live * self._stitch_width() / (2*math.pi) / r)[:, newaxis]
+        return P
+
+class symbolic(__base):
+    """A needle that runs a pattern with stitch counts and topology only.
+
+    No mesh, positions or relaxation; stitches are node ids. Use it to
+    check that a pattern's stitch counts work before building it for
+    real. Each needle call the pattern makes is one instruction (the
+    same numbering as a compiled program), and running out of stitches
+    raises a ValueError naming the instruction and row.
+    """
+    def __init__(self, end_row_turns=True, color="gray"):
+        self._end_row_turns = end_row_turns
+        self.color = color
+
+        self.stitches = _stitch_ring()
+        self.orientation = 1
+        self.cable_stitches = _stitch_ring()
+        self.cable_side = None
+
+        self._current_node = None
+        self._loose = None
+
+        # inbound[i] is the ids of the stitches node i was worked through
+        self.inbound = []
+        self.h_edges = []
+        self.row_counts = []
+        self.instruction = 0
+
+    def live_stitches(self):
+        return len(self.stitches) - (1 if self._end_row_turns else 0)
+
+    def _next(self):
+        i, self.instruction = self.instruction, self.instruction + 1
+        return i
+
+    def _fail(self, i):
+        raise ValueError(f"instruction {i} (row {len(self.row_counts)}): not enough stitches on the needle")
+
+    def _pop(self, i, from_cable=False):
+        q = self.cable_stitches if from_cable else self.stitches
+        if not len(q) or q[-1] is None:
+            self._fail(i)
+        return q.pop()
+
+    def _node(self, i, pull, push, from_cable=False):
+        if isinstance(pull, int):
+            pull = (pull,)
+        inbound = tuple(self._pop(i, from_cable) for grp in pull for k in range(grp))
+
+        n = len(self.inbound)
+        self.inbound.append(inbound)
+        if self._loose is not None:
+            self.h_edges.append((self._loose, n))
+        for k in range(push):
+            self.stitches.appendleft(n)
+        self._loose = n
+        self._current_node = n
+        return [n]
+
+    def cast_on(self, N, cinch=False):
+        # as flat.cast_on and circle.cast_on: a flat row is cast on backwards
+        # behind an end marker, a round is joined up
+        if self._end_row_turns:
+            self.stitches.append(None)
+            self.stitches.reverse()
+        first = len(self.inbound)
+        for k in range(N):
+            self._node(None, 0, 1)
+        if self._end_row_turns:
+            self.stitches.reverse()
+        else:
+            self.h_edges.append((self._loose, first))
+        self._loose = None
+        self.instruction = 0
+        return list(range(first, first + N))
+
+    def create_node(self, pull, push, knit_or_purl=0, from_cable_needle=False, color=None, node_class=None):
+        if not isinstance(pull, (int, tuple)):
+            raise TypeError
+        return self._node(self._next(), pull, push, from_cable_needle)
+
+    def work_stitches(self, count, knit_or_purl=0, color=None):
+        i = self._next()
+        return [ n for k in range(count) for n in self._node(i, 1, 1) ]
+
+    def work_into_current_node(self, knit_or_purl=0, color=None):
+        i = self._next()
+        if self._current_node is None:
+            raise ValueError(f"instruction {i}: no stitch to work into")
+        self.stitches.appendleft(self._current_node)
+        return []
+
+    def slip_to_cable_needle(self, N, front_or_back=0):
+        i = self._next()
+        for k in range(N):
+            self.cable_stitches.appendleft(self._pop(i))
+        return []
+
+    def yarnover(self, color=None):
+        return self._node(self._next(), 0, 1)
+
+    def slip_stitch(self, front_or_back=0):
+        self.stitches.appendleft(self._pop(self._next()))
+        return []
+
+    def _end_row(self):
+        self.row_counts.append(self.live_stitches())
+
+    def turn(self):
+        self._next()
+        self._end_row()
+        self._loose = None
+        self.stitches.reverse()
+        self.orientation *= -1
+
+    def end_row(self):
+        if self._end_row_turns:
+            self.turn()
+        else:
+            self._next()
+            self._end_row()
+
+    def bind_off_row(self, knit_or_purl=0):
+        result = []
+        for k in range(self.live_stitches()):
+            result.extend(self._node(None, 1, 0))
+        self._loose = None
+        return result
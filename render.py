@@ -0,0 +1,168 @@
+import struct
+import zlib
+import numpy as np
+from numpy import array, array_equal
+
+from vectors import I
+
+from colornames import rgb as _rgb
+
+def _spline(points, steps=8):
+    """Sample the parabolic spline tk draws for a smoothed line."""
+    if len(points) < 3:
+        return points
+    t = np.linspace(0, 1, steps + 1)[1:, None]
+    out = [points[:1]]
+    for i in range(len(points) - 2):
+        a = points[0] if i == 0 else (points[i] + points[i+1]) / 2
+        b = points[i+1]
+        c = points[-1] if i == len(points) - 3 else (points[i+1] + points[i+2]) / 2
+        out.append((1-t)**2 * a + 2*(1-t)*t * b + t**2 * c)
+    return np.concatenate(out)
+
+class _stroke(object):
+    def __init__(self, points, color, width, dot=False):
+        self.points = points
+        self.color = color
+        self.width = width
+        self.dot = dot
+
+class renderer(object):
+    def __init__(self, mesh, m=I, zoom=100.0, width=600, height=600, background="white"):
+        self.mesh = mesh
+        self.m = array(m, dtype=float)
+        self.zoom = zoom
+        self.width = width
+        self.height = height
+        self.center = array([width / 2, height / 2])
+        self.background = background
+
+    def strokes(self):
+        """Every line and dot display draws for a full redraw, in drawing order."""
+        self.mesh.cook_vectors(True)
+
+        nodes = [ n for n in self.mesh.nodes() if n.pos is not None ]
+        depth = array([ n.pos for n in nodes ], dtype=float).reshape(-1, 3) @ self.m[2]
+        segments = [ s for i in np.argsort(depth, kind='stable') for s in nodes[i].get_draw_segments(self.m) ]
+
+        # project every control point of every segment at once
+        counts = [ len(s.points) for s in segments ]
+        raw = array([ p for s in segments for p in s.points ], dtype=float).reshape(-1, 3)
+        xy = -(raw @ self.m.T)[:, 0:2] * self.zoom + self.center
+        starts = np.cumsum([0] + counts)
+
+        strokes = []
+        for s, a, b in zip(segments, starts[:-1], starts[1:]):
+            idx = list(range(a, b))
+            dots = []
+            for i in (1, -1):
+                if array_equal(raw[idx[i]], raw[idx[i-1]]):
+                    dots.append(xy[idx.pop(i)])
+            line = _spline(xy[idx]) if len(idx) > 1 else None
+
+            outline = self.zoom * s.thickness + 1
+            fill = self.zoom * s.thickness - 1
+            strokes.extend(_stroke(d[None], "black", outline, True) for d in dots)
+            if line is not None:
+                strokes.append(_stroke(line, "black", outline))
+                strokes.append(_stroke(line, s.color, fill))
+            strokes.extend(_stroke(d[None], s.color, fill, True) for d in dots)
+
+        return strokes
+
+    def svg(self):
+        out = [ f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{self.height}">',
+                f'<rect width="100%" height="100%" fill="{self._svg_color(self.background)}"/>' ]
+        for s in self.strokes():
+            color = self._svg_color(s.color)
+            if s.dot:
+                x, y = s.points[0]
+                out.append(f'<circle cx="{x:.2f}" cy="{y:.2f}" r="{max(s.width, 0) / 2:.2f}" fill="{color}"/>')
+            else:
+                path = " ".join(f"{x:.2f},{y:.2f}" for x, y in s.points)
+                out.append(f'<polyline points="{path}" fill="none" stroke="{color}" stroke-width="{max(s.width, 0):.2f}" '
+                           f'stroke-linejoin="round"/>')
+        out.append('</svg>')
+        return "\n".join(out)
+
+    @staticmethod
+    def _svg_color(color):
+        return "#%02x%02x%02x" % _rgb(color)
+
+    def raster(self):
+        """An (height, width, 3) uint8 image of the mesh."""
+        img = np.empty((self.height, self.width, 3), dtype=float)
+        img[:] = _rgb(self.background)
+        for s in self.strokes():
+            self._paint(img, s)
+        return np.round(img).astype(np.uint8)
+
+    def _paint(self, img, s):
+        r = max(s.width, 0) / 2
+        if r == 0:
+            return
+        if s.dot:
+            pieces = [ (s.points[0], s.points[0], True, True) ]
+        else:
+            n = len(s.points) - 1
+            pieces = [ (s.points[i], s.points[i+1], i == 0, i == n - 1) for i in range(n) ]
+
+        # coverage is the most of the pieces' coverages; each piece only
+        # looks at the pixels round its own bounding box
+        lo = np.floor(s.points.min(axis=0) - r - 1).astype(int)
+        hi = np.ceil(s.points.max(axis=0) + r + 1).astype(int)
+        X0, Y0 = np.maximum(lo, 0)
+        X1, Y1 = np.minimum(hi, (self.width, self.height))
+        if X0 >= X1 or Y0 >= Y1:
+            return
+        cover = np.zeros((Y1 - Y0, X1 - X0))
+
+        for a, b, first, last in pieces:
+            lo = np.floor(np.minimum(a, b) - r - 1).astype(int)
+            hi = np.ceil(np.maximum(a, b) + r + 1).astype(int)
+            x0, y0 = np.maximum(lo, (X0, Y0))
+            x1, y1 = np.minimum(hi, (X1, Y1))
+            if x0 >= x1 or y0 >= y1:
+                continue
+
+            gx, gy = np.meshgrid(np.arange(x0, x1) + 0.5, np.arange(y0, y1) + 0.5)
+            pix = np.stack([gx, gy], axis=2)
+
+            # distance to the piece; round joins, butt ends
+            ab = b - a
+            ll = ab @ ab
+            t = (pix - a) @ ab / (ll if ll > 0 else 1)
+            d = np.linalg.norm(pix - (a + np.clip(t, 0, 1)[:, :, None] * ab), axis=2)
+            if not s.dot:
+                if first:
+                    d[t < 0] = np.inf
+                if last:
+                    d[t > 1] = np.inf
+
+            c = cover[y0-Y0:y1-Y0, x0-X0:x1-X0]
+            np.maximum(c, np.clip(r - d + 0.5, 0, 1), out=c)
+
+        region = img[Y0:Y1, X0:X1]
+        region += (array(_rgb(s.color), dtype=float) - region) * cover[:, :, None]
+
+    def png(self):
+        img = self.raster()
+        raw = b"".join(b"\x00" + row.tobytes() for row in img)
+
+        def chunk(kind, data):
+            return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+        return (b"\x89PNG\r\n\x1a\n" +
+                chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0)) +
+                chunk(b"IDAT", zlib.compress(raw)) +
+                chunk(b"IEND", b""))
+
+    def save(self, filename):
+        if filename.endswith(".svg"):
+            with open(filename, "w") as f:
+                f.write(self.svg())
+        elif filename.endswith(".png"):
+            with open(filename, "wb") as f:
+                f.write(self.png())
+        else:
+            raise ValueError(f"can't tell the image format of {filename!r}")
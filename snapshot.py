@@ -0,0 +1,137 @@
+import numpy as np
+
+from model import mesh, node, bindoff_node, yarnover_node, h_edge, v_edge, crossover
+
+# what a snapshot can hold; block forces are arbitrary callables and are not saved
+_node_classes = [ node, bindoff_node, yarnover_node ]
+_edge_classes = [ h_edge, v_edge ]
+
+FORMAT = 1
+
+def save(msh, filename):
+    """Write the nodes, edges and crossovers of msh to an uncompressed .npz file."""
+    nodes = list(msh.nodes())
+    index = { n: i for i, n in enumerate(nodes) }
+    edges = list(msh.edges())
+    eindex = { e: i for i, e in enumerate(edges) }
+    # a crossover can outlive an edge it crosses (e.g. a slip with yarn in
+    # front at the end of a row loses its loose edge); like the array
+    # engine, leave those out
+    crossovers = [ c for c in msh.crossovers() if c.over in eindex and c.under in eindex ]
+
+    colors = sorted(set(e.color for e in edges))
+    cindex = { c: i for i, c in enumerate(colors) }
+
+    # each node joins its before edge and then its down edges, in that order
+    adj = msh.adjacency
+    joins = [ eindex[e] for n in nodes
+              for e in ([adj.before[n.id]] if n.id in adj.before else []) + adj.down.get(n.id, []) ]
+
+    np.savez(filename,
+             format=np.array(FORMAT),
+             current_node_id=np.array(msh.current_node_id),
+             node_id=np.array([ n.id for n in nodes ], dtype=int),
+             node_class=np.array([ _node_classes.index(type(n)) for n in nodes ], dtype=np.int8),
+             pos=np.array([ n.pos for n in nodes ], dtype=float).reshape(-1, 3),
+             rs_norm=np.array([ n.rs_norm for n in nodes ], dtype=np.int8),
+             ks_norm=np.array([ n.ks_norm for n in nodes ], dtype=np.int8),
+             edge_class=np.array([ _edge_classes.index(type(e)) for e in edges ], dtype=np.int8),
+             edge_before=np.array([ index[e.before] for e in edges ], dtype=int),
+             edge_after=np.array([ index[e.after] if e.after is not None else -1 for e in edges ], dtype=int),
+             edge_length=np.array([ e.length for e in edges ], dtype=float),
+             edge_thickness=np.array([ e.thickness for e in edges ], dtype=float),
+             edge_color=np.array([ cindex[e.color] for e in edges ], dtype=int),
+             colors=np.array(colors, dtype=str),
+             joins=np.array(joins, dtype=int),
+             crossover_edges=np.array([ [ eindex[c.over], eindex[c.under] ] for c in crossovers ], dtype=int).reshape(-1, 2),
+             crossover_normal=np.array([ c.normal for c in crossovers ], dtype=float),
+             crossover_thickness=np.array([ c.thickness for c in crossovers ], dtype=float))
+
+def load(filename):
+    """Rebuild a mesh saved with save(); node ids are preserved."""
+    with np.load(filename) as f:
+        if int(f["format"]) != FORMAT:
+            raise ValueError(f"unsupported snapshot format {int(f['format'])}")
+        data = { k: f[k] for k in f.files }
+
+    msh = mesh()
+
+    nodes = []
+    for i, cls in zip(data["node_id"].tolist(), data["node_class"].tolist()):
+        msh.current_node_id = i - 1
+        nodes.append(_node_classes[cls](msh, None, 0, 0, None, []))
+    msh.current_node_id = int(data["current_node_id"])
+
+    for n, p, rs, ks in zip(nodes, data["pos"], data["rs_norm"].tolist(), data["ks_norm"].tolist()):
+        n.pos, n.rs_norm, n.ks_norm = p, rs, ks
+
+    colors = data["colors"].tolist()
+    edges = [ _edge_classes[cls](msh, nodes[b], length, colors[c], thickness)
+              for cls, b, length, c, thickness in zip(data["edge_class"].tolist(), data["edge_before"].tolist(),
+                                                      data["edge_length"].tolist(), data["edge_color"].tolist(),
+                                                      data["edge_thickness"].tolist()) ]
+
+    after = data["edge_after"].tolist()
+    joins = data["joins"].tolist()
+    for e in joins + sorted(set(np.flatnonzero(data["edge_after"] >= 0).tolist()) - set(joins)):
+        edges[e].join(nodes[after[e]])
+
+    for (o, u), normal, thickness in zip(data["crossover_edges"].tolist(), data["crossover_normal"].tolist(),
+                                         data["crossover_thickness"].tolist()):
+        crossover(msh, edges[o], edges[u], normal, thickness)
+
+    return msh
+
+def warm_start(msh, previous):
+    """Seed node positions of msh from a relaxed mesh (or snapshot file) of an earlier pattern version.
+
+    Nodes are matched in construction order by stitch path: a node matches
+    the old node with the same matched before node and matched down nodes,
+    or failing that the old node that follows its matched before node
+    along the yarn. Unmatched nodes keep their construction position,
+    moved by the average displacement of their earlier neighbours.
+    Returns the number of matched nodes.
+    """
+    if not isinstance(previous, mesh):
+        previous = load(previous)
+
+    def earlier_neighbours(m, n):
+        adj = m.adjacency
+        before = adj.before.get(n.id)
+        before = before.before if before is not None and before.before.id < n.id else None
+        downs = [ e.before for e in adj.down.get(n.id, []) if e.before.id < n.id ]
+        return before, downs
+
+    old_by_path = {}
+    for o in previous.nodes():
+        before, downs = earlier_neighbours(previous, o)
+        key = (before and before.id, tuple(d.id for d in downs))
+        old_by_path.setdefault(key, o)
+
+    match = {}
+    used = set()
+    shift = {}
+    for n in msh.nodes():
+        before, downs = earlier_neighbours(msh, n)
+        mb = match.get(before)
+        md = [ match.get(d) for d in downs ]
+
+        o = None
+        if (before is None or mb) and all(md):
+            o = old_by_path.get((mb and mb.id, tuple(d.id for d in md)))
+        if (o is None or o in used) and mb is not None:
+            after = previous.adjacency.after.get(mb.id)
+            o = after.after if after is not None else None
+        if o is not None and o not in used and o.pos is not None:
+            match[n] = o
+            used.add(o)
+            shift[n] = o.pos - n.pos
+            n.pos = o.pos.copy()
+        else:
+            moved = [ shift[m] for m in [before] + downs if m in shift ]
+            if moved:
+                shift[n] = sum(moved) / len(moved)
+                n.pos = n.pos + shift[n]
+
+    msh.cook_vectors(True)
+    return len(match)
@@ -0,0 +1,552 @@
+import threading
+import numpy as np
+
+from model import yarnover_node, h_edge
+
+def _normalize(a):
+    n = np.linalg.norm(a, axis=1)
+    out = np.zeros_like(a)
+    nz = n > 0
+    out[nz] = a[nz] / n[nz, None]
+    return out
+
+def _rowdot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+class _node_view(object):
+    """A node as seen at position pos, without moving the node itself."""
+    def __init__(self, node, pos):
+        self._node = node
+        self.pos = pos
+
+    def __getattr__(self, name):
+        return getattr(self._node, name)
+
+class object_solver(object):
+    def __init__(self, msh):
+        self.mesh = msh
+        msh.cook_vectors(True)
+        self.nodes = list(msh.nodes())
+
+    def step(self):
+        old = self.positions()
+        forces = []
+
+        for obj in self.mesh.objects:
+            forces.extend(obj.get_forces())
+
+        for f in forces:
+            f.apply()
+
+        self.mesh.cook_vectors()
+        return np.linalg.norm(self.positions() - old, axis=1)
+
+    def positions(self):
+        return np.array([ n.pos for n in self.nodes ], dtype=float).reshape(-1, 3)
+
+    def current(self):
+        return [ n.pos for n in self.nodes ]
+
+    def finish(self):
+        pass
+
+class array_solver(object):
+    def __init__(self, msh, nodes=None):
+        # nodes: relax only these, holding on to edges between them
+        self.mesh = msh
+        msh.cook_vectors(True)
+
+        self.nodes = list(msh.nodes() if nodes is None else nodes)
+        index = { n: i for i, n in enumerate(self.nodes) }
+        self.index = index
+
+        self.edges = [ e for e in msh.edges() if e.before in index and e.after in index ]
+        eindex = { e: i for i, e in enumerate(self.edges) }
+
+        self.bef = np.array([ index[e.before] for e in self.edges ], dtype=int)
+        self.aft = np.array([ index[e.after] for e in self.edges ], dtype=int)
+        self.length = np.array([ e.length for e in self.edges ], dtype=float)
+        self.thickness = np.array([ e.thickness for e in self.edges ], dtype=float)
+        self.thick_mult = np.array([ e.thick_mult for e in self.edges ], dtype=float)
+
+        N = len(self.nodes)
+        self.rs_norm = np.array([ n.rs_norm for n in self.nodes ], dtype=float)
+        self.ks_norm = np.array([ n.ks_norm for n in self.nodes ], dtype=float)
+
+        before, after, up, down = msh.adjacency.csr(self.nodes, eindex)
+
+        def unpack(indptr, indices):
+            # edge counts include edges that are not relaxed (e.g. live stitches)
+            counts = np.diff(indptr)
+            n = np.repeat(np.arange(N), counts)
+            keep = indices >= 0
+            return n[keep], indices[keep], counts[n][keep]
+
+        self.up_n, self.up_e, self.up_count = unpack(*up)
+        self.down_n, self.down_e, self.down_count = unpack(*down)
+        self.n_up = np.bincount(self.up_n, minlength=N)
+        self.n_down = np.bincount(self.down_n, minlength=N)
+
+        # far ends of the horizontal neighbours, used for the h arrow
+        nodes = np.arange(N)
+        has_b, has_a = before >= 0, after >= 0
+        self.h_bef = np.where(has_b, self.bef[before], nodes)
+        self.h_aft = np.where(has_a, self.aft[after], nodes)
+
+        # tension: before, up and after edges of each node
+        t_n = np.concatenate([nodes[has_b], self.up_n, nodes[has_a]])
+        t_e = np.concatenate([before[has_b], self.up_e, after[has_a]])
+        self.t_n, self.t_e = t_n, t_e
+
+        # shear of vertical edges by the h arrow
+        self.hs_n = np.concatenate([self.down_n, self.up_n])
+        self.hs_e = np.concatenate([self.down_e, self.up_e])
+        self.hs_strength = 0.1 / np.concatenate([self.down_count, self.up_count])
+
+        # foldover and flattening of horizontal edges
+        both = has_b & has_a
+        self.hb_n = nodes[both]
+        self.hb_before = before[both]
+        self.hb_after = after[both]
+
+        # shear of horizontal edges by the v arrow
+        vs = np.array([ not isinstance(n, yarnover_node) for n in self.nodes ], dtype=bool)
+        self.vs_n = np.concatenate([nodes[has_b & vs], nodes[has_a & vs]])
+        self.vs_e = np.concatenate([before[has_b & vs], after[has_a & vs]])
+
+        # flattening of vertical edges, only for nodes with edges both up and down
+        fu = (self.n_down[self.up_n] > 0)
+        fd = (self.n_up[self.down_n] > 0)
+        self.fv_n = np.concatenate([self.up_n[fu], self.down_n[fd]])
+        self.fv_e = np.concatenate([self.up_e[fu], self.down_e[fd]])
+        self.fv_sign = np.concatenate([np.ones(fu.sum()), -np.ones(fd.sum())])
+
+        # edge tension, on every edge
+        self.et_e = np.arange(len(self.edges))
+
+        crossovers = [ c for c in msh.crossovers() if
+                       all(n in index for n in (c.over.before, c.over.after, c.under.before, c.under.after)) ]
+        self.co = np.array([ [ index[c.over.before], index[c.over.after], index[c.under.before], index[c.under.after] ]
+                             for c in crossovers ], dtype=int).reshape(-1, 4)
+        self.co_normal = np.array([ c.normal for c in crossovers ], dtype=float)
+        self.co_thickness = np.array([ c.thickness for c in crossovers ], dtype=float)
+
+        self.blocks = list(msh.blocks())
+
+        self.P = self.positions()
+
+    def positions(self):
+        return np.array([ n.pos for n in self.nodes ], dtype=float).reshape(-1, 3)
+
+    def store(self, P):
+        for n, p in zip(self.nodes, P):
+            n.pos = p
+        self.mesh.cook_vectors()
+
+    def frames(self, P):
+        H = _normalize(P[self.h_aft] - P[self.h_bef])
+
+        N = len(P)
+        upos = P.copy()
+        dpos = P.copy()
+        has_up, has_down = self.n_up > 0, self.n_down > 0
+        for k in range(3):
+            upos[has_up, k] = (np.bincount(self.up_n, P[self.aft[self.up_e], k], N) / np.maximum(self.n_up, 1))[has_up]
+            dpos[has_down, k] = (np.bincount(self.down_n, P[self.bef[self.down_e], k], N) / np.maximum(self.n_down, 1))[has_down]
+        V = _normalize(upos - dpos)
+
+        R = _normalize(np.cross(H, V)) * self.rs_norm[:, None]
+        return H, V, R
+
+    def deltas(self, P):
+        H, V, R = self.frames(P)
+        d = P[self.aft] - P[self.bef]
+        dn = np.linalg.norm(d, axis=1)
+
+        idx, dlt = [], []
+
+        def dot(e, arrow, offset, strength):
+            n = np.linalg.norm(arrow, axis=1)
+            nz = n > 0
+            e, arrow = e[nz], arrow[nz] / n[nz, None]
+            delta = arrow * ((_rowdot(arrow, d[e]) - offset[nz]) * strength[nz])[:, None]
+            idx.extend([ self.bef[e], self.aft[e] ])
+            dlt.extend([ delta, -delta ])
+
+        def full(x, like):
+            return np.broadcast_to(np.asarray(x, dtype=float), like.shape)
+
+        # node tension
+        w = self.thick_mult[self.t_e]
+        tension_length = np.bincount(self.t_n, self.length[self.t_e] * w, len(P))
+        tension_actual = np.bincount(self.t_n, dn[self.t_e] * w, len(P))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = tension_actual / tension_length
+            ratio = np.exp(0.5 * np.sin(np.arctan(np.log(ratio + 0.01))))
+        dot(self.t_e, d[self.t_e], dn[self.t_e] / ratio[self.t_n], full(0.25, self.t_e))
+
+        # node shear
+        dot(self.hs_e, H[self.hs_n], full(0, self.hs_e), self.hs_strength)
+        dot(self.vs_e, V[self.vs_n], full(0, self.vs_e), full(0.1, self.vs_e))
+
+        # node foldover
+        hb = H[self.hb_n]
+        fb = _rowdot(hb, P[self.hb_n] - P[self.bef[self.hb_before]]) < 0
+        fa = _rowdot(hb, P[self.aft[self.hb_after]] - P[self.hb_n]) < 0
+        dot(self.hb_before[fb], hb[fb], full(0, self.hb_before[fb]), full(0.1, self.hb_before[fb]))
+        dot(self.hb_after[fa], hb[fa], full(0, self.hb_after[fa]), full(0.1, self.hb_after[fa]))
+
+        # node flattening
+        nsign = self.rs_norm * self.ks_norm
+        dot(self.fv_e, R[self.fv_n], self.fv_sign * nsign[self.fv_n] * self.thickness[self.fv_e], full(0.1, self.fv_e))
+        dot(self.hb_before, R[self.hb_n], nsign[self.hb_n] * self.thickness[self.hb_before], full(0.1, self.hb_before))
+        dot(self.hb_after, R[self.hb_n], -nsign[self.hb_n] * self.thickness[self.hb_after], full(0.1, self.hb_after))
+
+        # edge tension
+        e = self.et_e
+        dot(e, d[e], self.length[e], full(0.1, e))
+
+        # crossovers
+        if len(self.co):
+            normal = R[self.co].sum(axis=1) * self.co_normal[:, None]
+            nn = np.linalg.norm(normal, axis=1)
+            nz = nn > 0
+            co, normal, thickness = self.co[nz], normal[nz] / nn[nz, None], self.co_thickness[nz]
+            over_dot = (_rowdot(P[co[:, 0]], normal) + _rowdot(P[co[:, 1]], normal)) / 2
+            under_dot = (_rowdot(P[co[:, 2]], normal) + _rowdot(P[co[:, 3]], normal)) / 2
+            close = over_dot - under_dot < thickness
+            delta = normal[close] * ((thickness + under_dot - over_dot)[close] * 0.1)[:, None]
+            for j, sign in enumerate((1, 1, -1, -1)):
+                idx.append(co[close, j])
+                dlt.append(sign * delta)
+
+        # blocking forces are arbitrary callables, so they are evaluated per
+        # node, on a view of it at P rather than the mesh's own node
+        for b in self.blocks:
+            for n in b.nodes:
+                i = self.index.get(n)
+                if i is None:
+                    continue
+                n = _node_view(n, P[i])
+                idx.append(np.array([i]))
+                dlt.append(np.asarray(b.f(n), dtype=float).reshape(1, 3))
+
+        idx = np.concatenate(idx)
+        dlt = np.concatenate(dlt)
+        D = np.empty_like(P)
+        for k in range(3):
+            D[:, k] = np.bincount(idx, dlt[:, k], len(P))
+        return D
+
+    def current(self):
+        return self.P
+
+    def step(self):
+        D = self.deltas(self.P)
+        self.P = self.P + D
+        return np.linalg.norm(D, axis=1)
+
+    def finish(self):
+        self.store(self.P)
+
+class wedge_solver(object):
+    """Relaxes a circle or tube pattern made of k identical wedges as one wedge.
+
+    Each round is split into k equal runs of stitches from where the
+    round starts; the run half way round is the wedge, and every other
+    node is the wedge node at the same place rotated round Z by whole
+    wedges. Frames and forces are worked out only for the wedge and the
+    few stitches round it they depend on, so a step costs about 1/k of a
+    full one. The wedge is kept away from the jog where one round runs
+    into the next, so the rest of the mesh follows by rotation everywhere
+    but there. Once the wedge moves less than settle, the whole mesh
+    takes over from the rotated copies and is stepped as by array_solver,
+    so that residuals (and convergence) are those of the whole mesh.
+    Both leave out the slow turning as a whole that a relaxed round keeps
+    up, which would otherwise hold the residual above tight tolerances.
+
+    Raises a ValueError naming the first difference if the rounds don't
+    split into k stitch-for-stitch copies of the wedge, or if the mesh as
+    placed doesn't sit round Z with the copies a wedge apart.
+    """
+    def __init__(self, msh, k, settle=None):
+        from tiling import levels
+
+        if k < 2:
+            raise ValueError("symmetry needs at least two wedges")
+        self.mesh = msh
+        self.full = full = array_solver(msh)
+        self.nodes = full.nodes
+        self.settle = settle
+        self.settled = False
+
+        rows = {}
+        for n, l in levels(msh).items():
+            rows.setdefault(l, []).append(n)
+
+        N = len(self.nodes)
+        wedge = []
+        self.owner = np.empty(N, dtype=int)
+        self.turn = np.empty(N, dtype=int)
+        sigma = np.empty(N, dtype=int)  # one wedge round
+        for r in sorted(rows):
+            row = [ full.index[n] for n in rows[r] ]
+            L = len(row)
+            if L % k:
+                raise ValueError(f"not {k}-fold symmetric: row {r} has {L} stitches")
+            p = L // k
+            for i, n in enumerate(row):
+                self.owner[n] = len(wedge) + i % p
+                self.turn[n] = (i // p - k // 2) % k
+                sigma[n] = row[(i + p) % L]
+            wedge.extend(row[k // 2 * p:][:p])
+        wedge = np.array(wedge, dtype=int)
+
+        self._check(k, sigma)
+        self.rot = self._rotations(k, sigma)
+
+        # the forces that reach a wedge node come from the wedge, its
+        # neighbours and the crossovers it is in; their frames need one
+        # more ring of neighbours round those
+        def ring(mask):
+            touches = mask[full.bef] | mask[full.aft]
+            out = mask.copy()
+            out[full.bef[touches]] = True
+            out[full.aft[touches]] = True
+            return out
+
+        mine = np.zeros(N, dtype=bool)
+        mine[wedge] = True
+        near = ring(mine)
+        crossing = np.zeros(N, dtype=bool)
+        crossing[full.co[mine[full.co].any(axis=1)].ravel()] = True
+        self.around = np.flatnonzero(ring(near | crossing))
+
+        sub = self.sub = array_solver(msh, [ self.nodes[i] for i in self.around ])
+        self.wedge = np.searchsorted(self.around, wedge)
+        mine, near = mine[self.around], near[self.around]
+
+        keep = near[sub.t_n]
+        sub.t_n, sub.t_e = sub.t_n[keep], sub.t_e[keep]
+        keep = near[sub.hs_n]
+        sub.hs_n, sub.hs_e, sub.hs_strength = sub.hs_n[keep], sub.hs_e[keep], sub.hs_strength[keep]
+        keep = near[sub.vs_n]
+        sub.vs_n, sub.vs_e = sub.vs_n[keep], sub.vs_e[keep]
+        keep = near[sub.hb_n]
+        sub.hb_n, sub.hb_before, sub.hb_after = sub.hb_n[keep], sub.hb_before[keep], sub.hb_after[keep]
+        keep = near[sub.fv_n]
+        sub.fv_n, sub.fv_e, sub.fv_sign = sub.fv_n[keep], sub.fv_e[keep], sub.fv_sign[keep]
+        sub.et_e = sub.et_e[mine[sub.bef[sub.et_e]] | mine[sub.aft[sub.et_e]]]
+        keep = mine[sub.co].any(axis=1)
+        sub.co, sub.co_normal, sub.co_thickness = sub.co[keep], sub.co_normal[keep], sub.co_thickness[keep]
+
+        # start from the average of the k copies, turned back onto the wedge
+        W = np.zeros((len(wedge), 3))
+        np.add.at(W, self.owner, np.einsum('nji,nj->ni', self.rot[self.turn], full.P))
+        self.W = W / k
+
+    def _check(self, k, sigma):
+        # every node's copy one wedge round has the same kind, sides and
+        # yarn, is worked through the copies of its stitches, and the
+        # crossovers are copies of each other; the yarn running on from
+        # one round into the next, and the end of the yarn, are not compared
+        full = self.full
+        nodes = full.nodes
+
+        def where(i):
+            return f"node {nodes[i].id}"
+
+        down = [ set() for n in nodes ]
+        for n, e in zip(full.down_n, full.down_e):
+            down[n].add(full.bef[e])
+        after = { full.bef[e]: e for e in range(len(full.edges)) if isinstance(full.edges[e], h_edge) }
+        end = max(range(len(nodes)), key=lambda i: nodes[i].id)
+
+        for i, j in enumerate(sigma):
+            a, b = nodes[i], nodes[j]
+            if type(a) != type(b) or a.rs_norm != b.rs_norm or a.ks_norm != b.ks_norm:
+                raise ValueError(f"not {k}-fold symmetric: {where(i)} is not the same stitch as {where(j)}")
+            if set(sigma[list(down[i])]) != down[j]:
+                raise ValueError(f"not {k}-fold symmetric: {where(i)} and {where(j)} are worked through different stitches")
+            if end in (i, j):
+                continue
+            yarn = [ (full.edges[after[n]].length, full.edges[after[n]].thickness, full.edges[after[n]].color)
+                     if n in after else None for n in (i, j) ]
+            if yarn[0] != yarn[1]:
+                raise ValueError(f"not {k}-fold symmetric: the yarn after {where(i)} differs from the yarn after {where(j)}")
+
+        crossings = { (tuple(c), n) for c, n in zip(full.co, full.co_normal) }
+        for c, n in zip(full.co, full.co_normal):
+            if (tuple(sigma[c]), n) not in crossings:
+                raise ValueError(f"not {k}-fold symmetric: the crossover at {where(c[0])} has no copy one wedge round")
+
+    def _rotations(self, k, sigma):
+        # each node's copy one wedge round, as placed, should be as far
+        # from Z and as high up, and turned one wedge round it one way or
+        # the other; a little of a stitch is allowed for the jog and the
+        # spiral of the rounds
+        full = self.full
+        P = full.P
+        stitch = np.mean([ e.length for e in full.edges if isinstance(e, h_edge) ])
+        r = np.linalg.norm(P[:, :2], axis=1)
+
+        off = np.abs(r[sigma] - r).mean() / stitch
+        if off > 0.25:
+            raise ValueError(f"not {k}-fold symmetric: the mesh doesn't sit round the Z axis "
+                             f"(copies one wedge round are {off:.2f} stitches nearer or further on average)")
+        off = np.abs(P[sigma, 2] - P[:, 2]).mean() / stitch
+        if off > 0.25:
+            raise ValueError(f"not {k}-fold symmetric: copies one wedge round are {off:.2f} stitches higher or lower on average")
+
+        away = r > stitch
+        turned = np.arctan2(P[sigma, 1], P[sigma, 0]) - np.arctan2(P[:, 1], P[:, 0])
+        turned = np.median(turned[away] % (2 * np.pi)) * k / (2 * np.pi) if away.any() else 1
+        if abs(turned - 1) < 0.25:
+            sign = 1
+        elif abs(turned - (k - 1)) < 0.25:
+            sign = -1
+        else:
+            raise ValueError(f"not {k}-fold symmetric: copies one wedge round are {turned:.2f} wedges round Z")
+
+        t = sign * 2 * np.pi * np.arange(k) / k
+        c, s = np.cos(t), np.sin(t)
+        R = np.zeros((k, 3, 3))
+        R[:, 0, 0], R[:, 0, 1], R[:, 1, 0], R[:, 1, 1], R[:, 2, 2] = c, -s, s, c, 1
+        return R
+
+    def unfold(self, W, nodes=slice(None)):
+        """Positions of every node (or of nodes) from the wedge's."""
+        return np.einsum('nij,nj->ni', self.rot[self.turn[nodes]], W[self.owner[nodes]])
+
+    @property
+    def P(self):
+        return self.full.P if self.settled else self.unfold(self.W)
+
+    def positions(self):
+        return self.P
+
+    def current(self):
+        return self.P
+
+    @staticmethod
+    def _unturned(B, D):
+        # the forces don't all pull along the yarn, so a relaxed mesh keeps
+        # turning slowly as a whole; that doesn't change its shape, so the
+        # motions in B are taken out of D
+        B = np.array([ b.ravel() for b in B ]).T
+        return D - (B @ np.linalg.lstsq(B, D.ravel(), rcond=None)[0]).reshape(D.shape)
+
+    def step(self):
+        if self.settled:
+            full = self.full
+            c = full.P - full.P.mean(axis=0)
+            rigid = [ np.cross(a, c) for a in np.eye(3) ] + [ np.broadcast_to(a, c.shape) for a in np.eye(3) ]
+            D = self._unturned(rigid, full.deltas(full.P))
+            full.P = full.P + D
+            return np.linalg.norm(D, axis=1)
+
+        # the copies can only turn together about Z
+        spin = [ np.cross([0, 0, 1], self.W) ]
+        D = self._unturned(spin, self.sub.deltas(self.unfold(self.W, self.around))[self.wedge])
+        self.W = self.W + D
+        moved = np.linalg.norm(D, axis=1)
+        if self.settle is not None and moved.max() < self.settle:
+            # the copies are as good as the wedge; now the jog
+            self.settled = True
+            self.full.P = self.unfold(self.W)
+            return self.step()
+        return moved
+
+    def store(self, P):
+        self.full.store(P)
+
+    def finish(self):
+        self.full.store(self.P)
+
+class relax_worker(object):
+    """Relaxes a mesh in a background thread with the array engine.
+
+    It stops after N iterations, at tol or when budget seconds of
+    relaxing are used up (time spent paused doesn't count). Node
+    positions are published every `every` iterations into a double
+    buffer. The thread does not write to the mesh, so apply() and
+    finish() belong in the thread that owns it (e.g. the display's event
+    loop).
+    """
+    def __init__(self, msh, N=None, tol=None, budget=None, every=10):
+        if N is None and tol is None and budget is None:
+            raise ValueError("relax needs an iteration count, a tolerance or a time budget")
+        self.mesh = msh
+        self.solver = msh.solver(vectorized=True)
+        self.record = None
+        self.every = every
+        self.args = (N, tol, budget)
+
+        self._buffers = [ self.solver.P.copy(), self.solver.P.copy() ]
+        self._front = 0
+        self._fresh = False
+        self._lock = threading.Lock()
+
+        self._running = threading.Event()
+        self._running.set()
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        from model import relax_record
+        self.record = relax_record()
+        for r in self.mesh.relax_steps(self.solver, *self.args, record=self.record):
+            if r.iterations % self.every == 0:
+                self._publish()
+            self._running.wait()
+            if self._stopped:
+                break
+        self._publish()
+
+    def _publish(self):
+        back = 1 - self._front
+        self._buffers[back][:] = self.solver.P
+        with self._lock:
+            self._front = back
+            self._fresh = True
+
+    def take(self):
+        """The latest published positions, or None if nothing new arrived."""
+        with self._lock:
+            if not self._fresh:
+                return None
+            self._fresh = False
+            return self._buffers[self._front].copy()
+
+    def apply(self, P):
+        self.solver.store(P)
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def stop(self):
+        self._stopped = True
+        self._running.set()
+
+    @property
+    def done(self):
+        return self.record is not None and not self._thread.is_alive()
+
+    def finish(self):
+        """Wait for the thread and store the final positions in the mesh."""
+        self.stop()
+        self._thread.join()
+        self.solver.finish()
+        return self.record
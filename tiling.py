@@ -0,0 +1,104 @@
+import numpy as np
+
+def levels(msh):
+    """The row of every node, counted from the cast-on row as 0, in node order.
+
+    A node is one row above the stitches it was worked through, and never
+    below the node before it on the yarn (so yarnovers and the stitches
+    after a slipped one stay in their row).
+    """
+    adj = msh.adjacency
+    level = {}
+    for n in msh.nodes():
+        before = adj.before.get(n.id)
+        l = level.get(before.before, 0) if before is not None and before.before.id < n.id else 0
+        for e in adj.down.get(n.id, []):
+            if e.before in level:
+                l = max(l, level[e.before] + 1)
+        level[n] = l
+    return level
+
+def _grid(msh):
+    # nodes by row, each row in the order it was worked
+    rows = {}
+    for n, l in levels(msh).items():
+        rows.setdefault(l, []).append(n)
+    return [ rows.get(l, []) for l in range(max(rows) + 1) ] if rows else []
+
+def _in_the_round(msh):
+    # the yarn comes back round to a node from one made after it, as when
+    # a circle or tube cast-on is joined
+    before = msh.adjacency.before
+    return any(n.id in before and before[n.id].before.id > n.id for n in msh.nodes())
+
+def _band(x, big, small, period):
+    # the place in small that x in big corresponds to: the first and last
+    # repeats match the sample's, everything between its middle repeat
+    if big <= small or x < period:
+        return x
+    elif x >= big - period:
+        return x - big + small
+    else:
+        return period + (x - period) % period
+
+def _plane(P):
+    # x, y and 1, for affine maps in the plane the fabric was built in
+    return np.c_[P[:, :2], np.ones(len(P))]
+
+def tile(msh, sample, rows, across, N=2000, vectorized=True, tol=None):
+    """Seed msh with the relaxed geometry of a smaller sample of the same motif.
+
+    sample is knitted the same way as msh (same cast-on and finishing)
+    but with the motif repeated across times across and at least three
+    times up; rows is the number of rows in one repeat. The sample is
+    relaxed here (tol can be looser than the final relax's). Its middle
+    repeat, which has repeats on every side, gives how much the fabric
+    shrinks or stretches in its plane; msh is scaled to match, and every
+    node is then moved by the local shape of its counterpart in the
+    sample: edge repeats from the sample's edges, inner ones from its
+    middle repeat.
+
+    This settles the stitches, not the slow, fabric-wide part of
+    relaxing (edges pulling in, curling), so it saves most at loose
+    tolerances and little at tight ones.
+    Returns the sample's relax_record.
+    """
+    if across < 3:
+        raise ValueError("the sample needs at least three repeats across")
+    if _in_the_round(msh) or _in_the_round(sample):
+        raise ValueError("tile works on flat fabric; circle and tube meshes are worked in the round")
+
+    small = _grid(sample)
+    big = _grid(msh)
+    if len(small) < 3 * rows or (len(big) - len(small)) % rows:
+        raise ValueError("sample and mesh rows don't line up by whole repeats")
+    for l, row in enumerate(small):
+        if not row or len(row) % across:
+            raise ValueError(f"sample row {l}: {len(row)} stitches don't make {across} repeats")
+
+    nodes = [ n for row in small for n in row ]
+    index = { n: i for i, n in enumerate(nodes) }
+    built = np.array([ n.pos for n in nodes ], dtype=float)
+    record = sample.relax(N, vectorized=vectorized, tol=tol)
+    relaxed = np.array([ n.pos for n in nodes ], dtype=float)
+
+    middle = [ index[n] for row in small[rows:2*rows] for n in row[len(row) // across:2 * len(row) // across] ]
+    A = np.linalg.lstsq(_plane(built[middle]), relaxed[middle, :2], rcond=None)[0]
+    local = relaxed - built
+    local[:, :2] = relaxed[:, :2] - _plane(built) @ A
+    local[:, 2] -= local[:, 2].mean()
+
+    for l, row in enumerate(big):
+        srow = small[_band(l, len(big), len(small), rows)]
+        width = len(srow) // across
+        if (len(row) - len(srow)) % width:
+            raise ValueError(f"row {l}: sample and mesh don't line up by whole repeats")
+
+        P = np.array([ n.pos for n in row ], dtype=float)
+        P[:, :2] = _plane(P) @ A
+        P += local[[ index[srow[_band(i, len(row), len(srow), width)]] for i in range(len(row)) ]]
+        for n, p in zip(row, P):
+            n.pos = p
+
+    msh.cook_vectors(True)
+    return record